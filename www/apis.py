@@ -27,6 +27,25 @@ class Page(object):
             self.limit = self.page_size
         self.has_next = self.page_index < self.page_count
         self.has_previous = self.page_index > 1
+        self.cursor = None
+        self.next_cursor = None
+
+    @classmethod
+    def from_cursor(cls, cursor, next_cursor, page_size=10):
+        '''
+        游标分页模式，由Model.find_page的结果生成，不统计总数
+        cursor: 当前页的游标，next_cursor: 下一页的游标，None表示没有下一页
+        '''
+        page = cls(0, page_size=page_size)
+        page.item_count = None
+        page.page_count = None
+        page.page_index = None
+        page.limit = page_size
+        page.cursor = cursor or None
+        page.next_cursor = next_cursor
+        page.has_next = next_cursor is not None
+        page.has_previous = page.cursor is not None
+        return page
 
     def __str__(self):
         return 'item_count: %s, page_count: %s, page_index: %s, page_size: %s, offset: %s, limit: %s' % (self.item_count, self.page_count, self.page_index, self.page_size, self.offset, self.limit)
@@ -40,7 +59,9 @@ def _dump(obj):
             'page_count': obj.page_count,
             'item_count': obj.item_count,
             'has_next': obj.has_next,
-            'has_previous': obj.has_previous
+            'has_previous': obj.has_previous,
+            'cursor': obj.cursor,
+            'next_cursor': obj.next_cursor
         }
     raise TypeError('%s is not JSON serializable' % obj)
 
@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+对比models中声明的索引和数据库中现有的索引，列出缺少的索引
+    python check_indexes.py          只打印缺少索引的create index语句
+    python check_indexes.py --apply  在数据库中创建缺少的索引
+'''
+
+import sys, logging
+
+from transwarp import db, orm
+from config import configs
+from models import User, Blog, Comment
+
+MODELS = (User, Blog, Comment)
+
+def check(apply=False):
+    missing = 0
+    for model in MODELS:
+        for index in orm.missing_indexes(model):
+            missing = missing + 1
+            sql = index.sql(model.__table__)
+            print sql
+            if apply:
+                db.update(sql)
+    if not missing:
+        print '-- all declared indexes exist.'
+    return missing
+
+if __name__=='__main__':
+    logging.basicConfig(level=logging.WARNING)
+    db.createEngine(**configs.db)
+    apply = '--apply' in sys.argv[1:]
+    sys.exit(1 if check(apply) and not apply else 0)
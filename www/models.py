@@ -9,38 +9,41 @@ import time
 import uuid
 
 from transwarp.db import next_id
-from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField
+from transwarp.orm import Model, StringField, BooleanField, FloatField, TextField, ForeignKey
 
 class User(Model):
 	__table__ = 'users'
 
 	id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-	email = StringField(updatable=False, ddl='varchar(50)')
+	email = StringField(updatable=False, unique=True, ddl='varchar(50)')
 	password = StringField(ddl='varchar(50)')
 	admin = BooleanField()
 	name = StringField(ddl='varchar(50)')
 	image = StringField(ddl='varchar(500)')
-	created_at = FloatField(updatable=False, default=time.time)
+	created_at = FloatField(updatable=False, index=True, default=time.time)
 
 class Blog(Model):
     __table__ = 'blogs'
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    user_id = StringField(updatable=False, ddl='varchar(50)')
+    user_id = ForeignKey('User', updatable=False)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     name = StringField(ddl='varchar(50)')
     summary = StringField(ddl='varchar(200)')
-    content = TextField()
-    created_at = FloatField(updatable=False, default=time.time)
+    # 正文只在日志页和编辑时用到，列表查询不读取
+    content = TextField(deferred=True)
+    created_at = FloatField(updatable=False, index=True, default=time.time)
 
 class Comment(Model):
     __table__ = 'comments'
+    # 日志页按blog_id查询并按created_at排序
+    __indexes__ = (('blog_id', 'created_at'),)
 
     id = StringField(primary_key=True, default=next_id, ddl='varchar(50)')
-    blog_id = StringField(updatable=False, ddl='varchar(50)')
-    user_id = StringField(updatable=False, ddl='varchar(50)')
+    blog_id = ForeignKey('Blog', updatable=False)
+    user_id = ForeignKey('User', updatable=False)
     user_name = StringField(ddl='varchar(50)')
     user_image = StringField(ddl='varchar(500)')
     content = TextField()
-    created_at = FloatField(updatable=False, default=time.time)
+    created_at = FloatField(updatable=False, index=True, default=time.time)
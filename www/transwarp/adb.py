@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+数据库访问接口的异步封装
+查询交给固定数量的工作线程执行，调用者立即得到Future，可以同时发出多个查询，
+再用result()或gather()取结果。工作线程数默认等于连接池的最大连接数，
+正在执行的查询数不会超过数据库连接数
+    f1 = adb.select('select * from blogs limit ?', 10)
+    f2 = adb.select_int('select count(id) from blogs')
+    blogs, total = adb.gather(f1, f2)
+工作线程使用提交时调用者的请求时限、read your writes窗口、查询日志和identity map(见`register_context`)，
+但不在调用者的事务中，所以事务中不能提交异步操作
+"""
+
+import sys
+import threading
+import logging
+import Queue
+
+import db
+
+class Future(object):
+    """
+    异步执行的结果
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+        #工作线程中写操作之后的read your writes窗口，取结果时带回调用者线程
+        self._sticky_until = 0.0
+
+    def done(self):
+        return self._done
+
+    def _wait(self, timeout):
+        with self._cond:
+            if not self._done:
+                self._cond.wait(timeout)
+            if not self._done:
+                raise db.DBError('Future is not done in %s seconds.' % timeout)
+
+    def result(self, timeout=None):
+        """
+        等待并返回结果，执行时抛出的异常在这里重新抛出
+        """
+        self._wait(timeout)
+        self._merge_sticky()
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        self._merge_sticky()
+        return self._exc_info and self._exc_info[1]
+
+    def _merge_sticky(self):
+        if self._sticky_until > db._db_ctx.sticky_until:
+            db._db_ctx.sticky_until = self._sticky_until
+
+    def add_done_callback(self, fn):
+        """
+        完成后调用fn(future)，已完成时立即调用
+        """
+        with self._cond:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self, result, exc_info, sticky_until=0.0):
+        with self._cond:
+            self._sticky_until = sticky_until
+            self._result = result
+            self._exc_info = exc_info
+            self._done = True
+            self._cond.notify_all()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, e:
+                logging.exception(e)
+
+class _Executor(object):
+    """
+    执行数据库操作的工作线程池
+    """
+    def __init__(self, workers):
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='adb-worker-%s' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        logging.info('Init async db executor with %s workers.' % workers)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, context, fn, args, kw = item
+            _apply_context(context)
+            try:
+                try:
+                    result = fn(*args, **kw)
+                except:
+                    future._finish(None, sys.exc_info(), db._db_ctx.sticky_until)
+                else:
+                    future._finish(result, None, db._db_ctx.sticky_until)
+            finally:
+                _apply_context(None)
+
+    def submit(self, fn, *args, **kw):
+        future = Future()
+        self._queue.put((future, _capture_context(), fn, args, kw))
+        return future
+
+    def shutdown(self):
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+
+_executor = None
+_lock = threading.Lock()
+
+def _capture_db():
+    ctx = db._db_ctx
+    return ctx.deadline, ctx.sticky_until, ctx.query_log
+
+def _apply_db(state):
+    ctx = db._db_ctx
+    ctx.deadline, ctx.sticky_until, ctx.query_log = state or (None, 0.0, None)
+
+#提交时在调用者线程中capture()，执行前在工作线程中apply(state)，执行后apply(None)清除
+_contexts = [(_capture_db, _apply_db)]
+
+def register_context(capture, apply):
+    """
+    登记需要带到工作线程的线程局部状态，如orm的identity map
+    """
+    _contexts.append((capture, apply))
+
+def _capture_context():
+    return [capture() for capture, apply in _contexts]
+
+def _apply_context(states):
+    for i, (capture, apply) in enumerate(_contexts):
+        apply(states and states[i])
+
+def _create_executor(workers):
+    global _executor
+    if workers is None:
+        workers = db.pool_stats().max_size
+    _executor = _Executor(workers)
+
+def init(workers=None):
+    """
+    创建工作线程，workers默认等于连接池的最大连接数
+    不调用init时第一次提交操作会按默认参数创建
+    """
+    with _lock:
+        if _executor is not None:
+            raise db.DBError('Async executor is already initialized.')
+        _create_executor(workers)
+
+def shutdown():
+    global _executor
+    with _lock:
+        executor = _executor
+        _executor = None
+    if executor:
+        executor.shutdown()
+
+def submit(fn, *args, **kw):
+    """
+    在工作线程中执行fn(*args, **kw)，返回Future
+    工作线程不在调用者的事务中，事务中提交时抛出DBError
+    """
+    if db._db_ctx.transactions:
+        raise db.DBError('Cannot submit async operations in a transaction, they would run outside it.')
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                _create_executor(None)
+    return _executor.submit(fn, *args, **kw)
+
+def gather(*futures, **kw):
+    """
+    等待所有Future完成，按顺序返回结果列表
+    """
+    timeout = kw.pop('timeout', None)
+    return [f.result(timeout) for f in futures]
+
+def select(sql, *args, **kw):
+    return submit(db.select, sql, *args, **kw)
+
+def select_one(sql, *args, **kw):
+    return submit(db.select_one, sql, *args, **kw)
+
+def select_int(sql, *args):
+    return submit(db.select_int, sql, *args)
+
+def update(sql, *args):
+    return submit(db.update, sql, *args)
+
+def insert(table, **kw):
+    return submit(db.insert, table, **kw)
+
+def insert_many(table, rows, chunk_size=db.INSERT_CHUNK_SIZE):
+    return submit(db.insert_many, table, rows, chunk_size)
+
+def upsert(table, row, keys=('id',), updates=None, increments=()):
+    return submit(db.upsert, table, row, keys, updates, increments)
+
+def delete(sql, *args):
+    return submit(db.delete, sql, *args)
+
+def _run_in_transaction(fn, *args, **kw):
+    with db.transaction():
+        return fn(*args, **kw)
+
+def transaction(fn, *args, **kw):
+    """
+    在一个工作线程的事务中执行fn(*args, **kw)，fn中的db操作都在这个事务里
+    """
+    return submit(_run_in_transaction, fn, *args, **kw)
@@ -4,12 +4,18 @@
 """
 数据库访问接口的python封装
 """
-#import sqlite3
+import sys
+import re
 import functools
 import threading
 import logging
+import logging.handlers
 import time
 import uuid
+import hashlib
+import heapq
+import collections
+import itertools
 
 class DBError(Exception):
     """
@@ -20,13 +26,25 @@ class DBError(Exception):
 class MultiColumnsError(DBError):
     pass
 
+class QueryTimeoutError(DBError):
+    """
+    语句执行超时或请求的数据库时限已到，语句已在服务器端取消
+    """
+    pass
+
+class PoolTimeoutError(DBError):
+    """
+    连接池在超时时间内没有可用连接
+    """
+    pass
+
 class Dict(dict):
     """
     增强型字典，继承原有的字典，可以将两个列表打包成字典，实现dict(zip(list1, list2))
     """
     def __init__(self, names=(), values=(), **kwargs):
         super(Dict, self).__init__(**kwargs)
-        self.update(dict(zip(names, values)))
+        self.update(itertools.izip(names, values))
 
     def __getattr__(self, key):
         try:
@@ -37,52 +55,1095 @@ class Dict(dict):
     def __setattr__(self, key, value):
         self[key] = value
 
+class Row(tuple):
+    """
+    紧凑的只读行对象，同一组列名的所有行共享一个列名到下标的映射
+    可以用row.name、row['name']或row[0]访问字段
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            try:
+                key = self._index[key]
+            except KeyError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+    def __getattr__(self, key):
+        try:
+            return tuple.__getitem__(self, self._index[key])
+        except KeyError:
+            raise AttributeError(r"'Row' object has no attribute '%s'" % key)
+
+    def get(self, key, default=None):
+        i = self._index.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def keys(self):
+        return list(self._fields)
+
+    def items(self):
+        return zip(self._fields, self)
+
+    def asdict(self):
+        return Dict(self._fields, self)
+
+    def __repr__(self):
+        return 'Row(%s)' % ', '.join(['%s=%r' % (k, v) for k, v in zip(self._fields, self)])
+
+#按列名缓存Row的子类
+_row_classes = {}
+
+def _row_class(names):
+    names = tuple(names)
+    cls = _row_classes.get(names)
+    if cls is None:
+        index = dict([(name, i) for i, name in enumerate(names)])
+        cls = _row_classes[names] = type('Row', (Row,), dict(__slots__=(), _fields=names, _index=index))
+    return cls
+
+#查询结果的行格式，由列名生成把一行的值转换为结果对象的函数
+_ROW_FORMATS = {
+    'dict': lambda names: lambda values: Dict(names, values),
+    'record': _row_class,
+    'tuple': lambda names: tuple,
+}
+
+def _row_maker(row, names):
+    """
+    row可以是'dict'、'record'、'tuple'，或以列名列表为参数、返回行转换函数的函数
+    """
+    if callable(row):
+        return row(names)
+    try:
+        return _ROW_FORMATS[row](names)
+    except KeyError:
+        raise DBError('Invalid row format: %s' % row)
+
 def next_id(t=None):
     if t is None:
         t = time.time()
     return '%015d%s000' % (int(t * 1000), uuid.uuid4().hex)
 
+#慢查询阈值(秒)
+SLOW_QUERY_THRESHOLD = 0.1
+
 def _profiling(start, sql=''):
     t = time.time() - start
-    if t > 0.1:
+    if t > SLOW_QUERY_THRESHOLD:
         logging.warning('[PROFILING] [DB] %s: %s' % (t, sql))
     else:
         logging.info('[PROFILING] [DB] %s: %s' % (t, sql))
 
 
+#语句缓存的最大条目数
+STATEMENT_CACHE_SIZE = 1000
+
+#每个连接上缓存的预编译语句数，超过时关闭最久未用的，服务器端的语句总数受max_prepared_stmt_count限制
+PREPARED_CACHE_SIZE = 50
+
+#占位符个数随数据量变化的语句：in (?,?...)、多行values (...),(...)和bulk_update的case when ? then ?
+_RE_VARIABLE_ARITY = re.compile(r'\bin\s*\(\s*(?:\?|%s)|\)\s*,\s*\(\s*(?:\?|%s)|\bwhen\s+(?:\?|%s)\s+then\b', re.I)
+
+def _variable_arity(sql):
+    """
+    每种长度都是不同的语句，不值得缓存
+    >>> _variable_arity('select * from t where id in (?,?,?)')
+    True
+    >>> _variable_arity('insert into t (a,b) values (%s,%s),(%s,%s)')
+    True
+    >>> _variable_arity('select * from t where id=? and name in (select name from u)')
+    False
+    """
+    return _RE_VARIABLE_ARITY.search(sql) is not None
+
+class _StatementCache(object):
+    """
+    最多保存size条的LRU缓存，on_evict在条目被淘汰时调用
+    不加锁，多线程共享时由调用者加锁
+    """
+    def __init__(self, size, on_evict=None):
+        self.size = size
+        self.on_evict = on_evict
+        self._data = collections.OrderedDict()
+
+    def get(self, key):
+        value = self._data.pop(key, None)
+        if value is not None:
+            #重新插入，移到最近使用的一端
+            self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        while len(self._data) > self.size:
+            k, old = self._data.popitem(last=False)
+            if self.on_evict:
+                self.on_evict(old)
+
+    def values(self):
+        return self._data.values()
+
+    def __len__(self):
+        return len(self._data)
+
+#原始sql到驱动格式sql的缓存
+_statements = _StatementCache(STATEMENT_CACHE_SIZE)
+_statements_lock = threading.Lock()
+
+def _translate(sql):
+    """
+    把'?'占位符转换为驱动使用的'%s'，结果按原始sql缓存，
+    变长的批量语句不缓存，不会挤掉热点语句
+    驱动本身支持'?'时原样返回
+    """
+    if engine.dialect.paramstyle == 'qmark':
+        return sql
+    with _statements_lock:
+        s = _statements.get(sql)
+    if s is None:
+        s = sql.replace('?', '%s')
+        if not _variable_arity(sql):
+            with _statements_lock:
+                _statements.put(sql, s)
+    return s
+
+def _close_cursor(cursor):
+    try:
+        cursor.close()
+    except Exception, e:
+        logging.warning('close prepared cursor failed: %s' % e)
+
+class _PooledConnection(object):
+    """
+    连接池中的连接，记录连接的创建时间和最近一次归还时间
+    statements缓存该连接上已预编译的语句游标，最多PREPARED_CACHE_SIZE个，淘汰时关闭
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.statements = _StatementCache(PREPARED_CACHE_SIZE, _close_cursor)
+
+    def cursor(self, *args, **kwargs):
+        return self.connection.cursor(*args, **kwargs)
+
+    def prepared_cursor(self, sql, cursor_args):
+        """
+        返回(cursor, cached)，cached为True的游标由连接缓存，用完不能关闭
+        变长的批量语句不预编译，使用普通游标，省去PREPARE和CLOSE的往返
+        """
+        cursor = self.statements.get(sql)
+        if cursor is not None:
+            return cursor, True
+        if _variable_arity(sql):
+            return self.connection.cursor(), False
+        cursor = self.connection.cursor(**cursor_args)
+        self.statements.put(sql, cursor)
+        return cursor, True
+
+    def in_transaction(self):
+        """
+        连接上是否可能有未结束的事务，无法判断时返回True
+        """
+        return self.pool._in_transaction is None or self.pool._in_transaction(self.connection)
+
+    def commit(self):
+        self.connection.commit()
+
+    def rollback(self):
+        self.connection.rollback()
+
+    def close(self):
+        self.connection.close()
+
+#获取连接等待时间直方图的区间上限(秒)
+_WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+class _ConnectionPool(object):
+    """
+    有界数据库连接池
+    min_size: 保持的最少连接数，创建连接池时即建立
+    max_size: 允许同时存在的最多连接数
+    timeout: 连接全部被占用时，获取连接的最长等待时间(秒)
+    idle_timeout: 空闲超过该时间(秒)的多余连接会被关闭
+    ping_interval: 空闲超过该时间(秒)的连接在取出时先做健康检查，0表示每次都检查
+    in_transaction: 判断驱动连接上是否有未结束的事务，归还时只在有事务时回滚，None表示总是回滚
+    """
+    def __init__(self, connect, ping=None, in_transaction=None, min_size=1, max_size=10, timeout=10.0, idle_timeout=300.0, ping_interval=5.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise DBError('Invalid pool size: min_size=%s, max_size=%s' % (min_size, max_size))
+        self._connect = connect
+        self._ping = ping
+        self._in_transaction = in_transaction
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self._cond = threading.Condition(threading.Lock())
+        #所有存活的连接，用于统计连接年龄
+        self._connections = set()
+        #统计数据
+        self._created = 0
+        self._closed = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._wait_histogram = [0] * (len(_WAIT_BUCKETS) + 1)
+        #空闲连接，后进先出，使最近用过的连接优先被复用
+        self._idle = collections.deque()
+        #已创建的连接总数(空闲+使用中)
+        self._size = 0
+        #close()之后归还的连接直接关闭
+        self._is_closed = False
+        for i in range(min_size):
+            self._size += 1
+            self._idle.append(self._open())
+
+    def _open(self):
+        connection = _PooledConnection(self._connect())
+        connection.pool = self
+        logging.info("open connection <%s>..." % hex(id(connection.connection)))
+        with self._cond:
+            self._connections.add(connection)
+            self._created += 1
+        return connection
+
+    def _close(self, connection):
+        logging.info("close connection <%s>..." % hex(id(connection.connection)))
+        with self._cond:
+            self._connections.discard(connection)
+            self._closed += 1
+        try:
+            connection.close()
+        except Exception, e:
+            logging.warning('close connection failed: %s' % e)
+
+    def _check(self, connection):
+        if self._ping is None or time.time() - connection.last_used < self.ping_interval:
+            return True
+        try:
+            self._ping(connection.connection)
+            return True
+        except Exception, e:
+            logging.warning('connection <%s> is broken: %s' % (hex(id(connection.connection)), e))
+            return False
+
+    def _reap(self):
+        """
+        回收空闲太久的连接，调用者需持有锁
+        """
+        now = time.time()
+        expired = []
+        #队首是最早归还的连接
+        while self._idle and self._size > self.min_size and now - self._idle[0].last_used > self.idle_timeout:
+            expired.append(self._idle.popleft())
+            self._size -= 1
+        return expired
+
+    def _take(self, deadline):
+        """
+        取出一个空闲连接；返回None表示已预留一个名额，由调用者新建连接
+        """
+        with self._cond:
+            if self._is_closed:
+                raise DBError('Connection pool is closed.')
+            while True:
+                expired = self._reap()
+                if self._idle or self._size < self.max_size:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError('No connection available in %s seconds (max_size=%s).' % (self.timeout, self.max_size))
+                self._cond.wait(remaining)
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                self._size += 1
+                connection = None
+        for c in expired:
+            self._close(c)
+        return connection
+
+    def connect_raw(self):
+        """
+        新建一个不受连接池管理的连接，用完由调用者关闭
+        """
+        return self._connect()
+
+    def discard(self, connection):
+        """
+        丢弃已断开的连接，空出一个名额
+        """
+        self._discard(connection)
+
+    def _discard(self, connection):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+        if connection is not None:
+            self._close(connection)
+
+    def acquire(self):
+        start = time.time()
+        deadline = start + self.timeout
+        while True:
+            connection = self._take(deadline)
+            if connection is None:
+                try:
+                    connection = self._open()
+                except:
+                    self._discard(None)
+                    raise
+                break
+            if self._check(connection):
+                break
+            self._discard(connection)
+        self._record_wait(time.time() - start)
+        return connection
+
+    def _record_wait(self, t):
+        i = 0
+        while i < len(_WAIT_BUCKETS) and t > _WAIT_BUCKETS[i]:
+            i += 1
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += t
+            self._wait_max = max(self._wait_max, t)
+            self._wait_histogram[i] += 1
+
+    def release(self, connection):
+        #结束连接上未提交的事务，避免下一个使用者读到旧的快照，没有事务时不多一次往返
+        try:
+            if connection.in_transaction():
+                connection.rollback()
+        except Exception, e:
+            logging.warning('reset connection <%s> failed: %s' % (hex(id(connection.connection)), e))
+            self._discard(connection)
+            return
+        connection.last_used = time.time()
+        with self._cond:
+            if not self._is_closed:
+                self._idle.append(connection)
+                self._cond.notify()
+                return
+        self._discard(connection)
+
+    def busy(self):
+        """
+        使用中的连接数
+        """
+        return self._size - len(self._idle)
+
+    def stats(self):
+        """
+        返回连接池的统计数据
+        """
+        now = time.time()
+        with self._cond:
+            idle = len(self._idle)
+            histogram = [('<=%s' % b, n) for b, n in zip(_WAIT_BUCKETS, self._wait_histogram)]
+            histogram.append(('>%s' % _WAIT_BUCKETS[-1], self._wait_histogram[-1]))
+            return Dict(
+                min_size=self.min_size,
+                max_size=self.max_size,
+                size=self._size,
+                idle=idle,
+                checked_out=self._size - idle,
+                created=self._created,
+                closed=self._closed,
+                checkouts=self._checkouts,
+                timeouts=self._timeouts,
+                wait_total=self._wait_total,
+                wait_max=self._wait_max,
+                wait_avg=self._wait_total / self._checkouts if self._checkouts else 0.0,
+                wait_histogram=histogram,
+                connection_ages=sorted([now - c.created_at for c in self._connections], reverse=True))
+
+    def close(self):
+        """
+        关闭空闲连接，使用中的连接在归还时关闭
+        """
+        with self._cond:
+            self._is_closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for c in idle:
+            self._close(c)
+
+class QueryLog(object):
+    """
+    记录一段时间内(通常是一次请求)执行的所有sql语句，以及耗时、行数和调用位置
+    """
+    def __init__(self):
+        self.queries = []
+        self.db_time = 0.0
+        #adb的工作线程也记录到调用者的QueryLog中
+        self._lock = threading.Lock()
+
+    def add(self, sql, t, rows):
+        query = Dict(sql=sql, time=t, rows=rows, caller=_caller())
+        with self._lock:
+            self.queries.append(query)
+            self.db_time += t
+
+    def repeated(self, n=2):
+        """
+        返回执行次数不少于n的语句及次数，用于发现N+1查询
+        """
+        counter = collections.Counter([q.sql for q in self.queries])
+        return [(sql, c) for sql, c in counter.most_common() if c >= n]
+
+    def __len__(self):
+        return len(self.queries)
+
+    def __str__(self):
+        return '%s queries, %.3fs' % (len(self.queries), self.db_time)
+
+#统计调用位置时跳过的模块
+_DB_MODULES = ('db', 'orm')
+
+def _caller():
+    """
+    返回db和orm模块之外的第一个调用位置
+    """
+    f = sys._getframe(1)
+    while f is not None and f.f_globals.get('__name__', '').split('.')[-1] in _DB_MODULES:
+        f = f.f_back
+    if f is None:
+        return ''
+    return '%s:%s %s' % (f.f_code.co_filename, f.f_lineno, f.f_code.co_name)
+
+_RE_FP_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_FP_NUMBER = re.compile(r'(?<![\w`])-?\d+(?:\.\d+)?(?:e[-+]?\d+)?\b', re.I)
+_RE_FP_PARAM = re.compile(r'%s|\?')
+_RE_FP_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*')
+_RE_FP_SPACE = re.compile(r'\s+')
+
+def fingerprint(sql):
+    """
+    去掉sql中的常量得到语句指纹，相同结构的语句指纹相同
+    >>> fingerprint("select * from users where email='a@b.com' and id in (1, 2, 3)")
+    'select * from users where email=? and id in (?+)'
+    >>> fingerprint('insert into `t` (`a`,`b`) values (%s,%s),(%s,%s)')
+    'insert into `t` (`a`,`b`) values (?+)'
+    """
+    fp = _RE_FP_STRING.sub('?', sql)
+    fp = _RE_FP_NUMBER.sub('?', fp)
+    fp = _RE_FP_PARAM.sub('?', fp)
+    fp = _RE_FP_LIST.sub('(?+)', fp)
+    return _RE_FP_SPACE.sub(' ', fp).strip().lower()
+
+class _SlowQueryLog(object):
+    """
+    慢查询日志
+    按语句指纹汇总所有查询的次数和耗时分布，超过threshold秒的查询保存到
+    内存中的环形缓冲区，并写入日志文件(如果指定了path)，慢的select语句同时记录EXPLAIN结果
+    """
+    #每个指纹保留的最近耗时样本数，用于计算分位数
+    SAMPLES = 1000
+
+    def __init__(self, threshold=SLOW_QUERY_THRESHOLD, max_entries=100, explain=True, path=None, max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.threshold = threshold
+        self.explain = explain
+        self._entries = collections.deque(maxlen=max_entries)
+        self._stats = {}
+        self._fingerprints = {}
+        self._lock = threading.Lock()
+        self._logger = None
+        if path:
+            self._logger = logging.getLogger('transwarp.db.slow')
+            self._logger.propagate = False
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            self._logger.addHandler(handler)
+            self._logger.setLevel(logging.INFO)
+
+    def _fingerprint(self, sql):
+        fp = self._fingerprints.get(sql)
+        if fp is None:
+            fp = fingerprint(sql)
+            if len(self._fingerprints) < STATEMENT_CACHE_SIZE:
+                self._fingerprints[sql] = fp
+        return fp
+
+    def add(self, sql, t, rows, explain=None):
+        fp = self._fingerprint(sql)
+        with self._lock:
+            stat = self._stats.get(fp)
+            if stat is None:
+                stat = self._stats[fp] = Dict(count=0, slow=0, total=0.0, max=0.0, samples=collections.deque(maxlen=self.SAMPLES))
+            stat.count += 1
+            stat.total += t
+            stat.max = max(stat.max, t)
+            stat.samples.append(t)
+            if t < self.threshold:
+                return
+            stat.slow += 1
+        plan = None
+        if self.explain and explain is not None:
+            try:
+                plan = explain()
+            except Exception, e:
+                logging.warning('explain failed: %s' % e)
+        entry = Dict(at=time.time(), time=t, rows=rows, sql=sql, fingerprint=fp, explain=plan)
+        self._entries.append(entry)
+        logging.warning('[SLOW QUERY] %.3fs: %s' % (t, sql))
+        if self._logger:
+            self._logger.info('%.3fs rows=%s %s | explain: %s' % (t, rows, sql, plan))
+
+    def entries(self):
+        return list(self._entries)
+
+    def stats(self):
+        """
+        返回每个指纹的次数、慢查询次数、平均、p50、p99和最大耗时，按总耗时排序
+        """
+        L = []
+        with self._lock:
+            items = [(fp, stat.count, stat.slow, stat.total, stat.max, sorted(stat.samples)) for fp, stat in self._stats.iteritems()]
+        for fp, count, slow, total, tmax, samples in items:
+            L.append(Dict(fingerprint=fp, count=count, slow=slow, total=total, avg=total / count, max=tmax,
+                p50=samples[int(len(samples) * 0.5)], p99=samples[min(len(samples) - 1, int(len(samples) * 0.99))]))
+        L.sort(key=lambda x: x.total, reverse=True)
+        return L
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._entries.clear()
+
+#慢查询日志，None表示未开启
+_slow_log = None
+
+def configure_slow_log(threshold=SLOW_QUERY_THRESHOLD, max_entries=100, explain=True, path=None, **kw):
+    """
+    开启慢查询日志
+    threshold: 慢查询阈值(秒)
+    max_entries: 内存中保留的最近慢查询条数
+    explain: 是否为慢的select语句记录EXPLAIN结果
+    path: 慢查询日志文件，按max_bytes大小滚动，保留backup_count个备份
+    """
+    global _slow_log
+    _slow_log = _SlowQueryLog(threshold, max_entries, explain, path, **kw)
+    return _slow_log
+
+def slow_queries():
+    """
+    返回最近的慢查询
+    """
+    return _slow_log.entries() if _slow_log else []
+
+def query_stats():
+    """
+    返回按语句指纹汇总的查询统计
+    """
+    return _slow_log.stats() if _slow_log else []
+
+def _sizeof(obj):
+    """
+    估算对象占用的字节数
+    """
+    if isinstance(obj, (tuple, list)):
+        return sys.getsizeof(obj) + sum([_sizeof(x) for x in obj])
+    return sys.getsizeof(obj)
+
+class LRUCache(object):
+    """
+    进程内的LRU缓存，按估算的字节数限制大小
+    接口与memcache客户端相同(get/set/delete)，可以用memcache.Client替换
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._data = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            value, expires, size = item
+            if expires and expires < time.time():
+                self._bytes -= size
+                return None
+            #重新插入，移到最近使用的一端
+            self._data[key] = item
+            return value
+
+    def set(self, key, value, time=0):
+        size = _sizeof(key) + _sizeof(value)
+        if size > self.max_bytes:
+            return False
+        expires = _now() + time if time else 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old:
+                self._bytes -= old[2]
+            self._data[key] = (value, expires, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                k, item = self._data.popitem(last=False)
+                self._bytes -= item[2]
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item:
+                self._bytes -= item[2]
+
+    def stats(self):
+        with self._lock:
+            return Dict(items=len(self._data), bytes=self._bytes, max_bytes=self.max_bytes)
+
+#LRUCache.set的参数time遮住了time模块
+_now = time.time
+
+_RE_WRITE_TABLE = re.compile(r'^\s*(?:insert(?:\s+ignore|\s+or\s+\w+)?\s+into|replace\s+into|update|delete\s+from|truncate(?:\s+table)?|(?:create|drop|alter)\s+table(?:\s+if\s+(?:not\s+)?exists)?)\s+`?(\w+)`?', re.I)
+_RE_READ_FROM = re.compile(r'\b(from|join)\s+', re.I)
+#表名、可选的别名和后面的逗号，别名不能是紧跟在表名后的关键字
+_RE_READ_TABLE = re.compile(r'`?(\w+)`?(?:\s+(?:as\s+)?(?!(?:where|join|inner|left|right|cross|natural|straight_join|on|using|group|order|limit|having|union|for|lock)\b)`?\w+`?)?(\s*,\s*)?', re.I)
+
+def _written_table(sql):
+    """
+    返回写操作语句修改的表名
+    >>> _written_table('update `blogs` set `name`=? where id=?')
+    'blogs'
+    >>> _written_table('select 1')
+    """
+    m = _RE_WRITE_TABLE.match(sql)
+    return m.group(1).lower() if m else None
+
+def _read_tables(sql):
+    """
+    返回查询读取的表名，from后是子查询等无法可靠解析时返回None
+    >>> _read_tables('select * from `blogs` b join users u on b.user_id=u.id')
+    ('blogs', 'users')
+    >>> _read_tables('select * from blogs as b, users u where b.user_id=u.id order by b.id, u.id')
+    ('blogs', 'users')
+    >>> _read_tables('select * from (select * from blogs) b, users u')
+    """
+    tables = set()
+    for m in _RE_READ_FROM.finditer(sql):
+        pos = m.end()
+        while True:
+            if sql.startswith('(', pos):
+                #join的子查询中的表会被单独找到，from后的子查询之后还可能有逗号分隔的表
+                if m.group(1).lower() == 'from':
+                    return None
+                break
+            t = _RE_READ_TABLE.match(sql, pos)
+            if not t:
+                break
+            tables.add(t.group(1).lower())
+            if not t.group(2):
+                break
+            pos = t.end()
+    return tuple(sorted(tables)) if tables else None
+
+class _QueryCache(object):
+    """
+    查询结果缓存
+    缓存键包含sql、参数和所涉及各表的版本号，表被修改时换一个新的版本号，
+    旧的缓存项不会再被命中，由LRU或过期时间淘汰
+    缓存的是列名和原始的行数据，每次命中时重新生成行对象，调用者修改结果不影响缓存
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def _generation(self, table):
+        key = 'gen:%s' % table
+        gen = self.backend.get(key)
+        if gen is None:
+            #版本号丢失(如被淘汰)时使用新的版本号，不会误中旧的缓存项
+            gen = uuid.uuid4().hex
+            self.backend.set(key, gen)
+        return gen
+
+    def key(self, sql, args, tables, first=False):
+        """
+        first区分select_one和select，同一条sql缓存的结果格式不同
+        """
+        gens = [self._generation(t) for t in tables]
+        return 'q:' + hashlib.md5(repr((sql, args, bool(first), gens))).hexdigest()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        self.backend.set(key, value, ttl)
+
+    def invalidate(self, table):
+        logging.info('invalidate query cache of table %s' % table)
+        self.backend.set('gen:%s' % table, uuid.uuid4().hex)
+
+    def stats(self):
+        stats = Dict(hits=self.hits, misses=self.misses)
+        if hasattr(self.backend, 'stats'):
+            stats.backend = self.backend.stats()
+        return stats
+
+#查询结果缓存，None表示未开启
+_query_cache = None
+
+def configure_query_cache(backend=None, max_bytes=32 * 1024 * 1024):
+    """
+    开启查询结果缓存，之后select(..., cache_ttl=N)的结果缓存N秒
+    backend: 提供get(key)、set(key, value, time)、delete(key)的缓存，如memcache.Client，
+             默认使用进程内最多max_bytes字节的LRUCache
+    insert/update/delete语句会使所修改表的缓存失效
+    """
+    global _query_cache
+    _query_cache = _QueryCache(backend if backend is not None else LRUCache(max_bytes))
+    return _query_cache
+
+def query_cache_stats():
+    return _query_cache.stats() if _query_cache else None
+
+def _invalidate(sql):
+    if _query_cache is None:
+        return
+    table = _written_table(sql)
+    if table:
+        _query_cache.invalidate(table)
+        #事务提交前其他请求可能把旧数据再次放入缓存，提交后需要再失效一次
+        if _db_ctx.transactions:
+            _db_ctx.written.add(table)
+
+def _explain(connection, sql, args):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(engine.dialect.explain + sql, args)
+        names = [x[0] for x in cursor.description]
+        return [Dict(names, values) for values in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+def _log_query(sql, start, rows, explain=None):
+    t = time.time() - start
+    log = _db_ctx.query_log
+    if log is not None:
+        log.add(sql, t, rows)
+    if _slow_log is not None:
+        _slow_log.add(sql, t, rows, explain)
+
+def set_deadline(seconds):
+    """
+    设置当前请求的数据库时限，之后的每条语句最多执行到时限为止，None表示不限制
+    """
+    _db_ctx.deadline = None if seconds is None else time.time() + seconds
+
+def end_request():
+    """
+    请求结束时清除线程上与请求相关的状态
+    """
+    _db_ctx.sticky_until = 0.0
+    _db_ctx.deadline = None
+
+def begin_query_log():
+    """
+    开始记录当前线程执行的sql语句，返回QueryLog
+    """
+    _db_ctx.query_log = QueryLog()
+    return _db_ctx.query_log
+
+def end_query_log():
+    """
+    停止记录当前线程执行的sql语句，返回记录结果
+    """
+    log = _db_ctx.query_log
+    _db_ctx.query_log = None
+    return log
+
+class _MySQLDialect(object):
+    """
+    MySQL(mysql.connector)的差异部分
+    """
+    name = 'mysql'
+    paramstyle = 'format'
+    #不缓存结果集的游标参数
+    stream_args = dict(buffered=False)
+    #未读完的非缓存结果集只能通过关闭连接丢弃，否则要把剩余的行全部读完
+    stream_blocks_connection = True
+    explain = 'explain '
+    #CR_SERVER_GONE_ERROR, CR_SERVER_LOST, CR_SERVER_LOST_EXTENDED
+    disconnect_errors = (2006, 2013, 2055)
+    #ER_QUERY_TIMEOUT, ER_QUERY_INTERRUPTED, MariaDB的ER_STATEMENT_TIMEOUT
+    timeout_errors = (3024, 1317, 1969)
+
+    def ping(self, connection):
+        connection.ping(reconnect=False)
+
+    def begin(self, connection):
+        #连接默认autocommit=True，事务外的读写不留下未结束的事务，由这里显式开始事务
+        connection.execute('start transaction')
+
+    def in_transaction(self, connection):
+        #mysql.connector根据服务器最近一次返回的状态判断，不访问数据库
+        return getattr(connection, 'in_transaction', True)
+
+    def cancel(self, connection):
+        """
+        通过另一个连接执行KILL QUERY取消connection上正在执行的语句
+        """
+        side = connection.pool.connect_raw()
+        try:
+            cursor = side.cursor()
+            cursor.execute('KILL QUERY %d' % connection.connection.connection_id)
+            cursor.close()
+        finally:
+            side.close()
+
+    def is_timeout(self, e):
+        return getattr(e, 'errno', None) in self.timeout_errors
+
+    def is_disconnect(self, e):
+        """
+        是否是连接断开(如超过wait_timeout被服务器关闭)引起的错误
+        """
+        return getattr(e, 'errno', None) in self.disconnect_errors
+
+    def upsert(self, table, cols, keys, updates, increments):
+        assignments = ['`%s`=values(`%s`)' % (c, c) for c in updates] + ['`%s`=`%s`+1' % (c, c) for c in increments]
+        #没有要更新的列时相当于insert ignore，但不忽略其他错误
+        assignments = assignments or ['`%s`=`%s`' % (keys[0], keys[0])]
+        return 'insert into `%s` (%s) values (%s) on duplicate key update %s' % (table, ','.join(['`%s`' % c for c in cols]), ','.join(['?'] * len(cols)), ','.join(assignments))
+
+    def indexes(self, table):
+        rows = select('select index_name, column_name, non_unique from information_schema.statistics where table_schema=database() and table_name=? order by index_name, seq_in_index', table, row='tuple')
+        indexes = collections.OrderedDict()
+        for name, column, non_unique in rows:
+            index = indexes.setdefault(name, Dict(name=name, columns=[], unique=not non_unique))
+            index.columns.append(column)
+        return indexes.values()
+
+class _SQLiteDialect(object):
+    """
+    SQLite(sqlite3)的差异部分，sqlite3的游标本身就是逐行读取的
+    """
+    name = 'sqlite'
+    paramstyle = 'qmark'
+    stream_args = {}
+    stream_blocks_connection = False
+    explain = 'explain query plan '
+
+    def ping(self, connection):
+        connection.execute('select 1').close()
+
+    def begin(self, connection):
+        #连接使用isolation_level=None，由这里显式开始事务
+        connection.execute('begin')
+
+    def in_transaction(self, connection):
+        #Python 2.7的sqlite3没有in_transaction，没有事务时rollback()不执行语句
+        return getattr(connection, 'in_transaction', True)
+
+    def cancel(self, connection):
+        #sqlite3允许在其他线程中调用interrupt()
+        connection.connection.interrupt()
+
+    def is_timeout(self, e):
+        return 'interrupted' in str(e)
+
+    def is_disconnect(self, e):
+        return False
+
+    def upsert(self, table, cols, keys, updates, increments):
+        """
+        3.24以上的SQLite支持on conflict do update，更早的版本只能用insert or replace替换整行
+        """
+        import sqlite3
+        values = (','.join(['`%s`' % c for c in cols]), ','.join(['?'] * len(cols)))
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            return 'insert or replace into `%s` (%s) values (%s)' % ((table,) + values)
+        assignments = ['`%s`=excluded.`%s`' % (c, c) for c in updates] + ['`%s`=`%s`+1' % (c, c) for c in increments]
+        action = assignments and 'do update set %s' % ','.join(assignments) or 'do nothing'
+        return 'insert into `%s` (%s) values (%s) on conflict(%s) %s' % ((table,) + values + (','.join(['`%s`' % k for k in keys]), action))
+
+    def indexes(self, table):
+        indexes = []
+        for r in select('pragma index_list(`%s`)' % table):
+            columns = [c.name for c in select('pragma index_info(`%s`)' % r.name)]
+            indexes.append(Dict(name=r.name, columns=columns, unique=bool(r.unique)))
+        pk = [c.name for c in select('pragma table_info(`%s`)' % table) if c.pk]
+        if pk and not [i for i in indexes if i.columns == pk]:
+            #integer primary key是rowid的别名，不在index_list中
+            indexes.append(Dict(name='PRIMARY', columns=pk, unique=True))
+        return indexes
+
 #数据库引擎对象
 class _Engine(object):
-    def __init__(self, connect):
-        self._connect = connect()
+    """
+    connect创建主库连接，dialect是数据库的差异部分
+    replicas是创建各个只读从库连接的函数列表
+    replica_policy: 选择从库的策略，'round_robin'轮询或'least_connections'使用中连接最少
+    sticky: 写操作之后的sticky秒内，同一请求的读操作仍然走主库，保证读到自己的写入
+    """
+    def __init__(self, connect, dialect, prepare_args=None, replicas=(), replica_policy='round_robin', sticky=0, **pool_args):
+        if replica_policy not in _REPLICA_POLICIES:
+            raise DBError('Invalid replica policy: %s' % replica_policy)
+        self.dialect = dialect
+        self._pool = _ConnectionPool(connect, dialect.ping, dialect.in_transaction, **pool_args)
+        self._replicas = [_ConnectionPool(c, dialect.ping, dialect.in_transaction, **pool_args) for c in replicas]
+        self._choose = getattr(self, '_choose_' + replica_policy)
+        self._counter = itertools.count()
+        self.sticky = sticky
+        #创建预编译语句游标的参数，None表示不使用预编译语句
+        self.prepare_args = prepare_args
+
+    @property
+    def has_replicas(self):
+        return len(self._replicas) > 0
+
+    def _choose_round_robin(self):
+        return self._replicas[next(self._counter) % len(self._replicas)]
+
+    def _choose_least_connections(self):
+        return min(self._replicas, key=lambda pool: pool.busy())
+
+    def connect(self, readonly=False):
+        """
+        readonly为True且配置了从库时从从库取连接
+        """
+        if readonly and self._replicas:
+            return self._choose().acquire()
+        return self._pool.acquire()
+
+    def release(self, connection):
+        connection.pool.release(connection)
+
+    def discard(self, connection):
+        connection.pool.discard(connection)
+
+    def stats(self):
+        stats = self._pool.stats()
+        stats.replicas = [pool.stats() for pool in self._replicas]
+        return stats
+
+    def close(self):
+        self._pool.close()
+        for pool in self._replicas:
+            pool.close()
 
-    def connect(self):
-        return self._connect
+_REPLICA_POLICIES = ('round_robin', 'least_connections')
 
 #全局数据库引擎
 engine = None
 
-def createEngine(user, password, database, host='127.0.0.1', port=3306, **kwargs):
+#连接池参数，createEngine的参数中以`pool_`开头
+_POOL_ARGS = ('min_size', 'max_size', 'timeout', 'idle_timeout', 'ping_interval')
+
+def _pop_pool_args(kwargs):
+    pool_args = dict()
+    for k in _POOL_ARGS:
+        if 'pool_' + k in kwargs:
+            pool_args[k] = kwargs.pop('pool_' + k)
+    return pool_args
+
+def createEngine(user=None, password=None, database=None, host='127.0.0.1', port=3306, backend='mysql', path=None, **kwargs):
     """
     创建数据库引擎，实现全局对象`engine`
+    backend: 'mysql'或'sqlite'，使用sqlite时由path指定数据库文件，见`_create_sqlite_engine`
+    连接池参数：pool_min_size, pool_max_size, pool_timeout, pool_idle_timeout, pool_ping_interval
+    prepared=True时在每个连接上缓存预编译语句，重复执行的sql不再被服务器重新解析
+    从库参数：
+    replicas: 从库连接参数的列表，如[dict(host='10.0.0.2'), dict(host='10.0.0.3', port=3307)]，
+              未指定的参数与主库相同。事务之外的select语句发往从库，其余语句发往主库
+    replica_policy: 'round_robin'或'least_connections'
+    read_your_writes: 写操作后多少秒内同一请求的读操作仍走主库，默认0
     """
-    import mysql.connector
     global engine
     if engine is not None:
         raise DBError("Engine is alreadyinitialized.")
+    if backend == 'sqlite':
+        engine = _create_sqlite_engine(path, **kwargs)
+        logging.info("Init sqlite engine <%s> ok." % hex(id(engine)))
+        return
+    if backend != 'mysql':
+        raise DBError('Unsupported backend: %s' % backend)
 
+    import mysql.connector
+    #连接池参数
+    pool_args = _pop_pool_args(kwargs)
+    prepare_args = dict(prepared=True, buffered=False) if kwargs.pop('prepared', False) else None
+    replicas = kwargs.pop('replicas', ())
+    replica_args = dict(replica_policy=kwargs.pop('replica_policy', 'round_robin'), sticky=kwargs.pop('read_your_writes', 0))
     #连接参数
     params = dict(user=user, password=password, database=database, host=host, port=port)
     #默认连接参数
-    defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=False)
+    defaults = dict(use_unicode=True, charset='utf8', collation='utf8_general_ci', autocommit=True)
     for k, v in defaults.iteritems():
         params[k] = kwargs.pop(k, v)
     #通过函数参数更新连接参数
     params.update(kwargs)
     params['buffered'] = True
+    replica_connects = []
+    for replica in replicas:
+        replica_params = dict(params)
+        replica_params.update(replica)
+        replica_connects.append(functools.partial(mysql.connector.connect, **replica_params))
+    pool_args.update(replica_args)
     #创建engine全局对象
-    engine = _Engine(lambda: mysql.connector.connect(**params))
+    engine = _Engine(lambda: mysql.connector.connect(**params), _MySQLDialect(), prepare_args, replica_connects, **pool_args)
     logging.info("Init mysql engine <%s> ok." % hex(id(engine)))
 
+def _sqlite_connect(path, wal, **params):
+    import sqlite3
+    #连接由连接池在线程间传递，同一时刻只有一个线程使用
+    #sqlite3默认的隐式事务会在savepoint等语句前自动提交，改为由transaction()显式开始事务
+    params.setdefault('isolation_level', None)
+    connection = sqlite3.connect(path, check_same_thread=False, **params)
+    if wal:
+        connection.execute('pragma journal_mode=wal').close()
+        connection.execute('pragma synchronous=normal').close()
+    return connection
+
+def _create_sqlite_engine(path, wal=True, shared_cache=False, prepared=False, **kwargs):
+    """
+    创建SQLite引擎，'?'占位符直接交给sqlite3，不做转换
+    wal: 使用WAL日志模式，读写互不阻塞，多个连接可以并发读
+    shared_cache: 进程内的连接共享页缓存，省内存，但表级锁会使并发读串行化
+    prepared: 加大sqlite3每个连接的语句缓存
+    其余参数(如timeout)传给sqlite3.connect
+    """
+    import sqlite3
+    if not path:
+        raise DBError('Path is required for sqlite backend.')
+    pool_args = _pop_pool_args(kwargs)
+    if path == ':memory:':
+        #每个内存数据库连接都是独立的数据库，只能使用一个连接
+        pool_args.update(min_size=1, max_size=1)
+        wal = False
+    if shared_cache:
+        sqlite3.enable_shared_cache(True)
+    if prepared:
+        kwargs.setdefault('cached_statements', STATEMENT_CACHE_SIZE)
+    return _Engine(functools.partial(_sqlite_connect, path, wal, **kwargs), _SQLiteDialect(), **pool_args)
+
+def pool_stats():
+    """
+    返回数据库连接池的统计数据：连接数、等待时间直方图、超时次数、连接年龄等
+    """
+    if engine is None:
+        raise DBError('Engine is not initialized.')
+    return engine.stats()
+
 class _LasyConnection(object):
     """
     获取数据库引擎连接资源句柄connection
@@ -90,46 +1151,128 @@ class _LasyConnection(object):
     操作commit, roolback
     关闭连接 cleanup
     """
-    def __init__(self):
+    def __init__(self, readonly=False):
         self.connection = None
-    def cursor(self):
+        self.readonly = readonly
+        #事务中连接断开时的错误信息，事务结束前不能再取新的连接
+        self.failed = None
+
+    def _checkout(self):
+        if self.failed:
+            raise DBError(self.failed)
         if self.connection is None:
-            connection = engine.connect()
-            #connection = sqlite3.connect("test.db")
-            logging.info("open connection <%s>..." % hex(id(connection)))
+            connection = engine.connect(self.readonly)
+            logging.debug("checkout connection <%s>..." % hex(id(connection.connection)))
             self.connection = connection
-        return self.connection.cursor()
+        return self.connection
+
+    def cursor(self, *args, **kwargs):
+        return self._checkout().cursor(*args, **kwargs)
+
+    def statement_cursor(self, sql):
+        """
+        返回执行sql的游标和用完后是否保留该游标
+        """
+        connection = self._checkout()
+        if engine.prepare_args is None:
+            return connection.cursor(), False
+        return connection.prepared_cursor(sql, engine.prepare_args)
+
+    def execute(self, sql):
+        """
+        执行不返回结果的控制语句，如savepoint
+        """
+        cursor = self.cursor()
+        try:
+            cursor.execute(sql)
+        finally:
+            cursor.close()
 
     def commit(self):
-        self.connection.commit()
+        if self.failed:
+            raise DBError(self.failed)
+        #事务中没有执行过语句时还没有取得连接
+        if self.connection:
+            self.connection.commit()
 
     def rollback(self):
-        self.connection.rollback()
+        if self.connection:
+            self.connection.rollback()
+
+    def invalidate(self):
+        """
+        丢弃已断开的连接，下次使用时从连接池重新获取
+        事务中断开时事务已经丢失，之后的语句、保存点和提交都抛出DBError，直到最外层事务结束
+        """
+        if self.connection:
+            connection = self.connection
+            self.connection = None
+            logging.warning("discard broken connection <%s>..." % hex(id(connection.connection)))
+            engine.discard(connection)
+            if _db_ctx.transactions and self is _db_ctx.connection:
+                self.failed = 'Connection lost in transaction, the transaction has been rolled back.'
 
     def cleanup(self):
         if self.connection:
             connection = self.connection
             self.connection = None
-            logging.info("close connection <%s>..." % hex(id(connection)))
-            connection.close()
+            logging.debug("return connection <%s>..." % hex(id(connection.connection)))
+            engine.release(connection)
 
 
 #持有数据库连接的上下文对象
 class _DbCtx(threading.local):
     def __init__(self):
         self.connection = None
+        self.replica = None
         self.transactions = 0
+        self.query_log = None
+        #在此时间之前读操作走主库(read your writes)
+        self.sticky_until = 0.0
+        #请求的数据库时限(绝对时间)
+        self.deadline = None
+        #事务中修改过的表，提交后使查询缓存失效
+        self.written = set()
 
     def isInit(self):
         return not self.connection is None
 
     def init(self):
         self.connection = _LasyConnection()
+        self.replica = _LasyConnection(readonly=True)
         self.transactions = 0
 
     def cleanup(self):
-        self.connection.cleanup()
+        connection, replica = self.connection, self.replica
         self.connection = None
+        self.replica = None
+        self.transactions = 0
+        try:
+            connection.cleanup()
+        finally:
+            replica.cleanup()
+
+    def use_replica(self):
+        """
+        读操作是否可以发往从库
+        """
+        return engine.has_replicas and self.transactions == 0 and time.time() >= self.sticky_until
+
+    def reader(self):
+        return self.replica if self.use_replica() else self.connection
+
+    def wrote(self):
+        if engine.sticky:
+            self.sticky_until = time.time() + engine.sticky
+
+    def time_limit(self, timeout=None):
+        """
+        返回下一条语句允许执行的秒数，综合语句的timeout和请求的时限，None表示不限制
+        """
+        if self.deadline is None:
+            return timeout
+        remaining = self.deadline - time.time()
+        return remaining if timeout is None else min(timeout, remaining)
 
     def cursor(self):
         return self.connection.cursor()
@@ -143,7 +1286,7 @@ class _ConnectionCtx(object):
         self.shouldCleanup = False
         if not _db_ctx.isInit():
             _db_ctx.init()
-            self.shuldCleanup = True
+            self.shouldCleanup = True
 
         return self
 
@@ -177,27 +1320,55 @@ def with_connection(func):
 
 
 class _TransactionCtx(object):
+    """
+    事务上下文，最外层开始和提交/回滚事务，嵌套的事务使用保存点(SAVEPOINT)，
+    内层出错只回滚到自己的保存点，外层可以捕获异常后继续并提交其余的工作
+    """
     def __enter__(self):
         global _db_ctx
         self.shouldCloseConn = False
-        if not _db_ctx.is_init():
+        if not _db_ctx.isInit():
             _db_ctx.init()
             self.shouldCloseConn = True
 
+        try:
+            if _db_ctx.transactions == 0:
+                logging.info('begin transaction...')
+                engine.dialect.begin(_db_ctx.connection)
+                self.savepoint = None
+            else:
+                self.savepoint = 'sp_%d' % _db_ctx.transactions
+                logging.info('begin nested transaction %s...' % self.savepoint)
+                _db_ctx.connection.execute('savepoint %s' % self.savepoint)
+        except:
+            if self.shouldCloseConn:
+                _db_ctx.cleanup()
+            raise
         _db_ctx.transactions += 1
-        logging.info('begin transaction...' if _db_ctx.transactions==1 else 'join current transaction...')
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         global _db_ctx
         _db_ctx.transactions -= 1
         try:
-            if _db_ctx.transactions==0:
-                if exc_type is None:
-                    self.commit()
+            if self.savepoint:
+                if exc_type is not None and _db_ctx.connection.failed:
+                    #连接已断开，保存点已不存在，保留原来的异常
+                    pass
+                elif exc_type is None:
+                    _db_ctx.connection.execute('release savepoint %s' % self.savepoint)
                 else:
-                    self.rollback()
+                    logging.warning('rollback to savepoint %s...' % self.savepoint)
+                    _db_ctx.connection.execute('rollback to savepoint %s' % self.savepoint)
+                    _db_ctx.connection.execute('release savepoint %s' % self.savepoint)
+            elif exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
         finally:
+            if _db_ctx.transactions == 0:
+                _db_ctx.written.clear()
+                _db_ctx.connection.failed = None
             if self.shouldCloseConn:
                 _db_ctx.cleanup()
 
@@ -207,6 +1378,9 @@ class _TransactionCtx(object):
         try:
             _db_ctx.connection.commit()
             logging.info('commit ok.')
+            if _query_cache is not None:
+                for table in _db_ctx.written:
+                    _query_cache.invalidate(table)
         except:
             logging.warning('commit failed. try rollback...')
             _db_ctx.connection.rollback()
@@ -228,81 +1402,399 @@ def with_transaction(func):
     @functools.wraps(func)
     def _wrapper(*args, **kwargs):
         _start = time.time()
-        with _TransactionCtx():
-            return func(*args, **kwargs)
-        _profiling(_start)
+        try:
+            with _TransactionCtx():
+                return func(*args, **kwargs)
+        finally:
+            _profiling(_start, func.__name__)
     return _wrapper
 
 
+class _Watchdog(object):
+    """
+    在一个后台线程中处理所有语句的超时，不为每条语句创建定时器线程
+    到期时间放在堆中，取消的条目不从堆中删除，只清除回调，到期时跳过
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+
+    def watch(self, limit, fn):
+        """
+        limit秒后在后台线程中调用fn()，返回用于unwatch的条目
+        """
+        entry = [time.time() + limit, next(self._counter), fn]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='db-watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+        return entry
+
+    def unwatch(self, entry):
+        with self._cond:
+            entry[2] = None
+
+    def _next(self):
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][2] is None:
+                    heapq.heappop(self._heap)
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay <= 0:
+                    entry = heapq.heappop(self._heap)
+                    fn, entry[2] = entry[2], None
+                    return fn
+                self._cond.wait(delay)
+
+    def _run(self):
+        while True:
+            fn = self._next()
+            try:
+                fn()
+            except Exception, e:
+                logging.exception(e)
+
+_watchdog = _Watchdog()
+
+class _StatementTimeout(object):
+    """
+    限制一条语句的执行时间
+    超时后由_watchdog通过dialect在服务器端取消语句，语句的sql不变，仍可使用缓存的预编译语句；
+    驱动因超时或取消抛出的错误转换为QueryTimeoutError
+    connection: 执行语句的连接池连接
+    """
+    def __init__(self, connection, limit):
+        self.connection = connection
+        self.limit = limit
+        self.entry = None
+        self.lock = threading.Lock()
+        self.done = False
+
+    def __enter__(self):
+        if self.limit is None:
+            return self
+        if self.limit <= 0:
+            raise QueryTimeoutError('Deadline exceeded before execution.')
+        connection = self.connection
+        self.entry = _watchdog.watch(self.limit, lambda: self._cancel(connection))
+        return self
+
+    def _cancel(self, connection):
+        with self.lock:
+            #语句已经结束，不能再取消，否则会中止同一连接上的下一条语句
+            if self.done:
+                return
+            logging.warning('cancel statement after %.3fs...' % self.limit)
+            try:
+                engine.dialect.cancel(connection)
+            except Exception, e:
+                logging.warning('cancel statement failed: %s' % e)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.lock:
+            self.done = True
+        if self.entry:
+            _watchdog.unwatch(self.entry)
+        if exc_type and self.limit is not None and engine.dialect.is_timeout(exc_value):
+            raise QueryTimeoutError('Statement exceeded %.3fs: %s' % (self.limit, exc_value))
+
+#select因连接断开失败时的最多重试次数，以及第一次重试前等待的秒数，之后每次加倍
+RETRY_LIMIT = 2
+RETRY_BACKOFF = 0.05
+
 @with_connection
-def _select(sql, first, *args):
+def _select(sql, first, *args, **kw):
     """
     查询函数
+    row: 行格式，见`_row_maker`
+    timeout: 最长执行秒数，超时抛出QueryTimeoutError，同时受请求时限(见`set_deadline`)的限制
+    cache_ttl: 开启查询缓存(见`configure_query_cache`)时结果缓存的秒数，事务中不使用缓存
+    cache_tables: 查询涉及的表，默认从sql中解析，无法解析时不使用缓存
+    查询是幂等的，不在事务中时遇到连接断开会换一个连接重试
     """
+    global _db_ctx
+    row = kw.pop('row', 'dict')
+    timeout = kw.pop('timeout', None)
+    cache_ttl = kw.pop('cache_ttl', None)
+    cache_tables = kw.pop('cache_tables', None)
+    sql = _translate(sql)
+    if cache_ttl and _query_cache is not None and _db_ctx.transactions == 0:
+        tables = cache_tables or _read_tables(sql)
+        if tables:
+            return _cached_select(sql, first, args, row, timeout, cache_ttl, tables)
+        logging.warning('cannot find tables of query, not cached, use cache_tables: %s' % sql)
+    return _select_retry(sql, first, args, row, timeout)
+
+def _cached_select(sql, first, args, row, timeout, cache_ttl, tables):
+    key = _query_cache.key(sql, args, tables, first)
+    cached = _query_cache.get(key)
+    if cached is None:
+        columns = []
+        def _raw(names):
+            columns[:] = names
+            return tuple
+        values = _select_retry(sql, first, args, _raw, timeout)
+        cached = (tuple(columns), values)
+        _query_cache.set(key, cached, cache_ttl)
+    names, values = cached
+    if values is None:
+        return None
+    make = _row_maker(row, names)
+    return make(values) if first else map(make, values)
+
+def _select_retry(sql, first, args, row, timeout):
+    attempt = 0
+    while True:
+        try:
+            return _select_once(sql, first, args, row, timeout)
+        except Exception, e:
+            if not engine.dialect.is_disconnect(e) or _db_ctx.transactions or attempt >= RETRY_LIMIT:
+                raise
+            delay = RETRY_BACKOFF * (2 ** attempt)
+            attempt += 1
+            logging.warning('connection lost: %s, retry %s in %ss...' % (e, attempt, delay))
+            time.sleep(delay)
+
+def _close_broken(cursor):
+    """
+    关闭断开的连接上的游标，忽略错误，保留引起断开的原始异常
+    """
+    try:
+        if cursor:
+            cursor.close()
+    except Exception, e:
+        logging.warning('close cursor failed: %s' % e)
+
+def _select_once(sql, first, args, row, timeout):
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', "%s")
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    keep = False
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    start = time.time()
+    rows = None
+    connection = _db_ctx.reader()
+    limit = _db_ctx.time_limit(timeout)
 
     try:
-        #通过数据库上下文获取查询游标`cursor`
-        cursor = _db_ctx.connection.cursor()
-        #执行sql查询
-        cursor.execute(sql, args)
-        #处理查询结果，返回对象列表
-        if cursor.description:
-            names = [x[0] for x in cursor.description]
-        if first:
-            values = cursor.fetchone()
-            if not values:
-                return None
-            return Dict(names, values)
-        return [Dict(names, x) for x in cursor.fetchall()]
+        with _StatementTimeout(connection._checkout(), limit):
+            #通过数据库上下文获取查询游标`cursor`
+            cursor, keep = connection.statement_cursor(sql)
+            #执行sql查询
+            cursor.execute(sql, args)
+            #处理查询结果，返回对象列表，sqlite的pragma没有结果时description为None
+            names = [x[0] for x in cursor.description] if cursor.description else []
+            make = _row_maker(row, names)
+            if first:
+                #缓存的游标会被再次使用，必须读完结果集
+                values = cursor.fetchone() if not keep else next(iter(cursor.fetchall()), None)
+                if not values:
+                    rows = 0
+                    return None
+                rows = 1
+                return make(values)
+            L = map(make, cursor.fetchall())
+            rows = len(L)
+            return L
+    except Exception, e:
+        if engine.dialect.is_disconnect(e):
+            _close_broken(cursor)
+            cursor = None
+            connection.invalidate()
+        raise
     finally:
         #关闭游标
-        if cursor:
+        if cursor and not keep:
             cursor.close()
+        #执行成功的慢select语句才需要EXPLAIN
+        _log_query(sql, start, rows, (lambda: _explain(connection, sql, args)) if rows is not None else None)
 
 @with_connection
-def _update(sql, *args):
+def _update(sql, *args, **kw):
+    """
+    timeout: 最长执行秒数，见`_select`
+    """
     global _db_ctx
     cursor = None
-    sql = sql.replace('?', '%s')
-    logging.info('SQL: %s, ARGS: %s' % (sql, args))
+    keep = False
+    sql = _translate(sql)
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    start = time.time()
+    r = None
+    limit = _db_ctx.time_limit(kw.pop('timeout', None))
     try:
-        cursor = _db_ctx.connection.cursor()
-        cursor.execute(sql, args)
+        with _StatementTimeout(_db_ctx.connection._checkout(), limit):
+            cursor, keep = _db_ctx.connection.statement_cursor(sql)
+            cursor.execute(sql, args)
         r = cursor.rowcount
-        if _db_ctx.transactions == 0:
+        _db_ctx.wrote()
+        _invalidate(sql)
+        if _db_ctx.transactions == 0 and _db_ctx.connection.connection.in_transaction():
             logging.info('auto commit')
             _db_ctx.connection.commit()
         return r
+    except Exception, e:
+        #写操作不是幂等的，不重试，只丢弃断开的连接
+        if engine.dialect.is_disconnect(e):
+            _close_broken(cursor)
+            cursor = None
+            _db_ctx.connection.invalidate()
+        raise
     finally:
-        if cursor:
+        if cursor and not keep:
             cursor.close()
+        _log_query(sql, start, r)
 
-def update(sql, *args):
-    return _update(sql, *args)
+def update(sql, *args, **kw):
+    return _update(sql, *args, **kw)
 
 def insert(table, **kwargs):
     cols, args = zip(*kwargs.iteritems())
     sql = 'insert into `%s` (%s) values (%s)' % (table, ','.join(['`%s`' % col for col in cols]), ','.join(['?' for i in range(len(cols))]))
     return _update(sql, *args)
 
-def delete(sql, *args):
-    return _update(sql, *args)
+#insert_many每条insert语句最多插入的行数
+INSERT_CHUNK_SIZE = 500
+
+def insert_many(table, rows, chunk_size=INSERT_CHUNK_SIZE):
+    """
+    批量插入，rows是字段相同的字典列表
+    每chunk_size行生成一条多行insert语句，全部在同一个事务中执行，返回插入的行数
+    """
+    rows = list(rows)
+    if not rows:
+        return 0
+    cols = rows[0].keys()
+    placeholder = '(%s)' % ','.join(['?' for col in cols])
+    prefix = 'insert into `%s` (%s) values ' % (table, ','.join(['`%s`' % col for col in cols]))
+    r = 0
+    with transaction():
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            args = []
+            for row in chunk:
+                if len(row) != len(cols):
+                    raise DBError('Expect same columns in all rows.')
+                args.extend([row[col] for col in cols])
+            r += _update(prefix + ','.join([placeholder] * len(chunk)), *args)
+    return r
 
-def select_int(sql, *args):
-    d = _select(sql, True, *args)
+def upsert(table, row, keys=('id',), updates=None, increments=()):
+    """
+    插入一行，keys上的主键或唯一索引冲突时改为更新已有的行
+    updates: 冲突时更新为新值的列，默认是row中除keys以外的所有列
+    increments: 冲突时加1的列，如版本号
+    MySQL使用insert ... on duplicate key update，SQLite使用insert ... on conflict do update
+    返回影响的行数，MySQL中插入为1，更新为2
+    """
+    cols = row.keys()
+    if updates is None:
+        updates = [c for c in cols if not c in keys]
+    sql = engine.dialect.upsert(table, cols, keys, updates, increments)
+    return _update(sql, *[row[c] for c in cols])
+
+def delete(sql, *args, **kw):
+    return _update(sql, *args, **kw)
+
+def select_int(sql, *args, **kw):
+    d = _select(sql, True, *args, **kw)
     if len(d) != 1:
         raise MultiColumnsError('Expect only one column.')
     return d.values()[0]
 
-def select(sql, *args):
-    return _select(sql, False, *args)
+def select(sql, *args, **kw):
+    """
+    row='record'时返回Row对象，见`_row_maker`
+    timeout: 最长执行秒数，超时抛出QueryTimeoutError
+    cache_ttl: 结果缓存的秒数，见`configure_query_cache`
+    """
+    return _select(sql, False, *args, **kw)
+
+def select_one(sql, *args, **kw):
+    return _select(sql, True, *args, **kw)
+
+def table_indexes(table):
+    """
+    从数据库读取表上现有的索引(包括主键)，返回Dict(name, columns, unique)的列表
+    """
+    return engine.dialect.indexes(table)
 
-def select_one(sql, *args):
-    return _select(sql, True, *args)
+#select_iter每次从数据库读取的行数
+ITER_BATCH_SIZE = 100
+
+def select_iter(sql, *args, **kw):
+    """
+    流式查询，返回逐行产生Dict的生成器，不在内存中保存整个结果集
+    batch: 每次fetchmany读取的行数
+    row: 行格式，见`_row_maker`
+    timeout: 执行语句和每次fetchmany的最长秒数，同时受请求时限(见`set_deadline`)的限制，
+             超时抛出QueryTimeoutError
+    不在事务中时单独从连接池取一个连接，迭代结束(或生成器被回收)时归还；
+    MySQL中提前结束迭代时关闭该连接，不读取剩余的行
+    事务中使用事务所在的连接，MySQL的非缓存结果集会占住连接，迭代时不能执行其他语句，
+    所以事务中的结果集先全部读到客户端，不是真正的流式读取，大表应在事务外遍历
+    """
+    global _db_ctx
+    batch = kw.pop('batch', ITER_BATCH_SIZE)
+    row = kw.pop('row', 'dict')
+    timeout = kw.pop('timeout', None)
+    if kw:
+        raise TypeError('Unexpected keyword arguments: %s' % ','.join(kw.keys()))
+    sql = _translate(sql)
+    logging.info('SQL: %s, ARGS: %s', sql, args)
+    limit = _db_ctx.time_limit(timeout)
+    if limit is not None and limit <= 0:
+        raise QueryTimeoutError('Deadline exceeded before execution.')
+    #事务中的查询必须使用事务所在的连接
+    connection = _db_ctx.connection if _db_ctx.isInit() and _db_ctx.transactions else None
+    owned = connection is None
+    if owned:
+        connection = engine.connect(_db_ctx.use_replica())
+    pooled = connection if owned else connection._checkout()
+    cursor = None
+    done = False
+    broken = False
+    start = time.time()
+    count = 0
+    try:
+        cursor = connection.cursor(**(engine.dialect.stream_args if owned else {}))
+        with _StatementTimeout(pooled, limit):
+            cursor.execute(sql, args)
+        make = _row_maker(row, [x[0] for x in cursor.description])
+        while True:
+            #请求时限在迭代过程中不断逼近，每次读取前重新计算
+            with _StatementTimeout(pooled, _db_ctx.time_limit(timeout)):
+                rows = cursor.fetchmany(batch)
+            if not rows:
+                done = True
+                break
+            count += len(rows)
+            for values in rows:
+                yield make(values)
+    except Exception, e:
+        broken = engine.dialect.is_disconnect(e)
+        raise
+    finally:
+        _log_query(sql, start, count)
+        #提前结束迭代时丢弃连接，不读取剩余的行
+        abandoned = owned and not done and engine.dialect.stream_blocks_connection
+        broken = broken or abandoned
+        try:
+            if cursor and not broken:
+                cursor.close()
+        finally:
+            if owned:
+                (engine.discard if broken else engine.release)(connection)
+            elif broken:
+                connection.invalidate()
 
 
 if __name__=='__main__':
@@ -7,8 +7,13 @@
 """
 
 import time
+import json
+import base64
 import logging
+import itertools
+import threading
 import db
+import adb
 
 """
 保存数据库表的字段名和字段类型
@@ -23,6 +28,10 @@ class Field(object):
         self.updatable = kv.get('updatable', True)
         self.insertable = kv.get('insertable', True)
         self.ddl = kv.get('ddl', '')
+        self.index = kv.get('index', False)
+        #延迟加载的列，查询列表时不读取，第一次访问时再读取
+        self.deferred = kv.get('deferred', False)
+        self.unique = kv.get('unique', False)
         self._order = Field._count
         Field._count = Field._count + 1
 
@@ -36,6 +45,9 @@ class Field(object):
         self.nullable and s.append('N')
         self.updatable and s.append('U')
         self.insertable and s.append('I')
+        self.unique and s.append('Q')
+        self.index and s.append('X')
+        self.deferred and s.append('D')
         s.append('>')
         return ''.join(s)
 
@@ -95,14 +107,94 @@ class BlobField(Field):
 
         super(BlobField, self).__init__(**kv)
 
+class ForeignKey(Field):
+    """
+    引用另一个Model主键的字段，model是被引用的Model类名
+        user_id = ForeignKey('User', updatable=False)
+    对象的comment.user按需读取被引用的对象，也可以查询时用prefetch=('user',)批量读取
+    关系名默认是字段名去掉_id，也可以用relation指定
+    """
+    def __init__(self, model, **kv):
+        if not 'default' in kv:
+            kv['default'] = ''
+        if not 'ddl' in kv:
+            kv['ddl'] = 'varchar(50)'
+        self.model = model
+        self.relation = kv.pop('relation', None)
+        super(ForeignKey, self).__init__(**kv)
+
 class VersionField(Field):
+    """
+    乐观锁的版本号，每次update()时加1，
+    更新条件带上读取时的版本号，已被其他人修改时抛出StaleObjectError
+    """
     def __init__(self, name=None):
-        super(VersionField, self).__init__(name=name, default=0, ddl='biginit')
+        super(VersionField, self).__init__(name=name, default=0, updatable=False, ddl='bigint')
+
+class StaleObjectError(db.DBError):
+    """
+    对象读取后已被其他人修改或删除
+    """
+    pass
 
 _triggers = frozenset(['pre_insert', 'pre_update', 'pre_delete'])
 
+class Index(object):
+    """
+    表上的索引，在Model的__indexes__中声明联合索引:
+        __indexes__ = (('blog_id', 'created_at'), Index('user_id', 'name', unique=True))
+    单列索引用Field(index=True)或Field(unique=True)声明
+    """
+    def __init__(self, *columns, **kw):
+        if not columns:
+            raise TypeError('Index needs at least one column.')
+        self.columns = tuple(columns)
+        self.unique = kw.get('unique', False)
+        self.name = kw.get('name', None)
+
+    def sql(self, table_name):
+        return 'create %sindex `%s` on `%s` (%s);' % (self.unique and 'unique ' or '', self.name, table_name, ','.join(['`%s`' % c for c in self.columns]))
+
+    def covered_by(self, columns, unique):
+        """
+        数据库中已有的索引(columns, unique)能否代替这个索引：
+        普通索引只要是已有索引的最左前缀，唯一索引要求列完全相同且也是唯一索引
+        """
+        columns = tuple(columns)
+        if self.unique:
+            return unique and columns == self.columns
+        return columns[:len(self.columns)] == self.columns
+
+    def __str__(self):
+        return '<Index:%s,(%s)%s>' % (self.name, ','.join(self.columns), self.unique and ',unique' or '')
 
-def _gen_sql(table_name, mappings):
+    __repr__ = __str__
+
+def _gen_indexes(table_name, mappings, declared):
+    """
+    合并Field上的index/unique和__indexes__中的联合索引，检查列名并生成索引名
+    """
+    indexes = []
+    for f in sorted(mappings.values(), lambda x, y: cmp(x._order, y._order)):
+        if (f.index or f.unique) and not f.primary_key:
+            indexes.append(Index(f.name, unique=f.unique))
+    for index in declared:
+        if isinstance(index, basestring):
+            index = Index(index)
+        elif not isinstance(index, Index):
+            index = Index(*index)
+        indexes.append(index)
+    names = set([f.name for f in mappings.itervalues()])
+    for index in indexes:
+        for c in index.columns:
+            if not c in names:
+                raise TypeError('Index column "%s" not defined in table: %s' % (c, table_name))
+        if not index.name:
+            index.name = 'idx_%s_%s' % (table_name, '_'.join(index.columns))
+    return indexes
+
+
+def _gen_sql(table_name, mappings, indexes=()):
     pk = None
     sql = ['-- generating SQL for %s:' % table_name, 'create table `%s` (' % table_name]
     for f in sorted(mappings.values(), lambda x, y: cmp(x._order, y._order)):
@@ -116,8 +208,89 @@ def _gen_sql(table_name, mappings):
 
     sql.append(' primary key(`%s`)' % pk)
     sql.append(');')
+    sql.extend([index.sql(table_name) for index in indexes])
     return '\n'.join(sql)
 
+def _gen_select(table_name, columns=None):
+    if columns is None:
+        return 'select * from `%s`' % table_name
+    return 'select %s from `%s`' % (','.join(['`%s`' % c for c in columns]), table_name)
+
+def _gen_statements(table_name, pk, columns=None):
+    """
+    生成Model常用的固定sql语句，每个类只生成一次
+    columns: 查询列表时读取的列，None表示所有列
+    get按主键查询单个对象，总是读取所有列
+    """
+    return dict(
+        get='select * from `%s` where `%s`=?' % (table_name, pk),
+        select=_gen_select(table_name, columns),
+        count_all='select count(`%s`) from `%s`' % (pk, table_name),
+        delete='delete from `%s` where `%s`=?' % (table_name, pk))
+
+def _encode_cursor(values):
+    """
+    把排序列和主键的值编码为不透明的游标
+    >>> _decode_cursor(_encode_cursor([1466000000.5, u'0014']))
+    [1466000000.5, u'0014']
+    """
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':'))).rstrip('=')
+
+def _decode_cursor(cursor):
+    try:
+        cursor = str(cursor)
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor: %s' % cursor)
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError('Invalid cursor: %s' % cursor)
+    return values
+
+class _IdentityMap(threading.local):
+    """
+    请求内已读取的对象，以(Model类, 主键)为键，objects为None表示没有开启
+    """
+    def __init__(self):
+        self.objects = None
+
+_identity_map = _IdentityMap()
+
+def _apply_identity_map(objects):
+    _identity_map.objects = objects
+
+#异步查询在工作线程中使用调用者的identity map
+adb.register_context(lambda: _identity_map.objects, _apply_identity_map)
+
+#where pk in (...)每次查询的最多主键数
+IN_CHUNK_SIZE = 500
+
+#bulk_update每条update语句更新的最多对象数
+BULK_UPDATE_CHUNK_SIZE = 100
+
+def begin_identity_map():
+    """
+    开启当前线程的identity map，之后Model.get(pk)先在已读取的对象中查找，
+    查询到的对象也放入其中，一般由web.identity_map_interceptor在请求开始时调用
+    只跟踪通过Model读写的对象，直接用db.update修改的数据在end_identity_map前可能读到旧对象
+    """
+    _identity_map.objects = {}
+
+def end_identity_map():
+    _identity_map.objects = None
+
+def _gen_relations(name, mappings):
+    """
+    关系名到ForeignKey字段名的映射
+    """
+    relations = {}
+    for k, v in mappings.iteritems():
+        if isinstance(v, ForeignKey):
+            relation = v.relation or (k.endswith('_id') and k[:-3])
+            if not relation or relation in mappings:
+                raise TypeError('Invalid relation name for field %s in class: %s' % (k, name))
+            relations[relation] = k
+    return relations
+
 """
 动态定制继承自Model的子类，自动通过ModelMetaclass扫描映射关系，并
 存储到自身的class中
@@ -130,12 +303,10 @@ class ModelMetaclass(type):
         if name=='Model':
             return type.__new__(cls, name, bases, attrs)
 
-        # 保存子类信息
+        # 保存子类信息，类名到类的映射，ForeignKey通过类名找到被引用的Model
         if not hasattr(cls, 'subclasses'):
             cls.subclasses = {}
-        if not name in cls.subclasses:
-            cls.subclasses[name] = name
-        else:
+        if name in cls.subclasses:
             logging.warning("Redefine class: %s" % name)
 
         logging.info("Scan ORMapping %s..." % name)
@@ -170,15 +341,29 @@ class ModelMetaclass(type):
         if not '__table__' in attrs:
             attrs['__table__'] = name.lower()
 
+        indexes = _gen_indexes(attrs['__table__'], mappings, attrs.get('__indexes__', ()))
+
         attrs['__mappings__'] = mappings
         attrs['__primary_key__'] = primary_key
-        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings)
+        attrs['__indexes__'] = indexes
+        attrs['__sql__'] = lambda self: _gen_sql(attrs['__table__'], mappings, indexes)
+        ordered = [k for k, v in sorted(mappings.iteritems(), lambda x, y: cmp(x[1]._order, y[1]._order))]
+        attrs['__deferred__'] = frozenset([k for k in ordered if mappings[k].deferred])
+        columns = [k for k in ordered if not k in attrs['__deferred__']] if attrs['__deferred__'] else None
+        attrs['__statements__'] = _gen_statements(attrs['__table__'], primary_key.name, columns)
+        attrs['__relations__'] = _gen_relations(name, mappings)
+        versions = [k for k, v in mappings.iteritems() if isinstance(v, VersionField)]
+        if len(versions) > 1:
+            raise TypeError("Cannot define more than 1 version field in class:%s" % name)
+        attrs['__version_field__'] = versions and versions[0] or None
 
         for trigger in _triggers:
             if not trigger in attrs:
                 attrs[trigger] = None
 
-        return type.__new__(cls, name, bases, attrs)
+        model = type.__new__(cls, name, bases, attrs)
+        cls.subclasses[name] = model
+        return model
 
 
 """
@@ -195,86 +380,405 @@ class Model(dict):
         try:
             return self[key]
         except KeyError:
+            if key in self.__relations__:
+                self.__class__.prefetch([self], key)
+                return self.__dict__[key]
+            #从数据库读取的对象缺少的字段是延迟加载的列
+            if key in self.__mappings__ and '_loaded' in self.__dict__:
+                self.__class__.load_deferred([self])
+                if key in self:
+                    return self[key]
             raise AttributeError(r"'Dict' object has no attribute '%s'" % key)
 
     def __setattr__(self, key, value):
         self[key] = value
 
+    @classmethod
+    def _row(cls, names):
+        """
+        作为db查询的行格式，直接由列名和值创建对象，不经过中间的Dict
+        同时引用查询到的原始值作为快照，update()时只写入改变了的列
+        """
+        names = tuple(names)
+        def _make(values):
+            obj = dict.__new__(cls)
+            dict.update(obj, itertools.izip(names, values))
+            obj.__dict__['_loaded'] = (names, values)
+            return obj
+        return _make
+
+    def _merge_loaded(self, names, values):
+        """
+        加入延迟读取的列，同时加入快照，不算作修改
+        """
+        dict.update(self, itertools.izip(names, values))
+        loaded_names, loaded_values = self.__dict__.get('_loaded', ((), ()))
+        self.__dict__['_loaded'] = (loaded_names + tuple(names), loaded_values + tuple(values))
+
+    @classmethod
+    def _remember(cls, objs):
+        """
+        把查询到的对象放入identity map，已有的对象不替换，返回的列表中使用已有的对象
+        新查询到而已有对象中没有的列合并到已有对象中，已有的值(可能已被修改)保持不变
+        """
+        objects = _identity_map.objects
+        if objects is None:
+            return objs
+        pk = cls.__primary_key__.name
+        result = []
+        for obj in objs:
+            existing = objects.setdefault((cls, obj[pk]), obj)
+            if existing is not obj:
+                names = [k for k in obj if not k in existing]
+                if names:
+                    existing._merge_loaded(names, [obj[k] for k in names])
+            result.append(existing)
+        return result
+
+    def _mark_clean(self):
+        """
+        以当前的值作为快照，写入数据库后调用
+        """
+        self.__dict__['_loaded'] = (tuple(self.iterkeys()), tuple(self.itervalues()))
+
+    def _dirty_fields(self):
+        """
+        和快照相比改变了的可更新字段，快照中没有的字段只要有值就算改变
+        不是从数据库读取的对象没有快照，返回None
+        """
+        loaded = self.__dict__.get('_loaded')
+        if loaded is None:
+            return None
+        loaded = dict(itertools.izip(*loaded))
+        return [k for k, v in self.__mappings__.iteritems() if v.updatable and k in self and (not k in loaded or self[k] != loaded[k])]
+
+    @classmethod
+    def _select_sql(cls, kw):
+        """
+        kw中的columns指定读取的列(见`only`/`defer`)，默认不读取延迟加载的列
+        """
+        columns = kw.pop('columns', None)
+        if columns is None:
+            return cls.__statements__['select']
+        return _gen_select(cls.__table__, columns)
+
+    @classmethod
+    def _columns(cls, fields):
+        names = [k for k, v in sorted(cls.__mappings__.iteritems(), lambda x, y: cmp(x[1]._order, y[1]._order))]
+        for f in fields:
+            if not f in cls.__mappings__:
+                raise AttributeError('%s has no field: %s' % (cls.__name__, f))
+        return tuple([k for k in names if k in fields or k == cls.__primary_key__.name])
+
+    @classmethod
+    def query(cls):
+        """
+        可以链式组合条件的查询，见`Query`
+            Blog.query().where(user_id=uid).order_by('-created_at').limit(10).all()
+        """
+        return Query(cls)
+
+    @classmethod
+    def only(cls, *fields):
+        """
+        只读取指定的字段(和主键)，其他字段在访问时再读取
+            Blog.only('name', 'summary').find_by('order by created_at desc limit ?', 10)
+        """
+        return _ColumnsQuery(cls, cls._columns(fields))
+
+    @classmethod
+    def defer(cls, *fields):
+        """
+        除了定义为deferred的字段，这次查询还延迟读取指定的字段
+        """
+        cls._columns(fields)
+        return _ColumnsQuery(cls, cls._columns([k for k in cls.__mappings__ if not k in fields and not k in cls.__deferred__]))
+
+    @classmethod
+    def load_deferred(cls, objs, chunk_size=IN_CHUNK_SIZE):
+        """
+        为一批对象一次读取还没有读取的字段，避免逐个访问时每个对象查询一次
+        """
+        pk = cls.__primary_key__.name
+        pending = {}
+        fields = set()
+        for obj in objs:
+            absent = [k for k in cls.__mappings__ if not k in obj]
+            if absent:
+                pending[obj[pk]] = obj
+                fields.update(absent)
+        if not pending:
+            return objs
+        columns = cls._columns(fields)
+        keys = pending.keys()
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            sql = '%s where `%s` in (%s)' % (_gen_select(cls.__table__, columns), pk, ','.join(['?'] * len(chunk)))
+            for values in db.select(sql, *chunk, row='tuple'):
+                row = dict(itertools.izip(columns, values))
+                obj = pending[row[pk]]
+                names = [k for k in columns if not k in obj]
+                obj._merge_loaded(names, [row[k] for k in names])
+        return objs
+
     # 添加class方法
     @classmethod
-    def get(cls, pk):
+    def get(cls, pk, **kw):
+        """
+        通过主键查询，读取所有字段
+        cache_ttl: 结果缓存的秒数，见`db.configure_query_cache`，下同
+        columns: 只读取的字段，一般通过`only`/`defer`指定，下同
+        """
+        objects = _identity_map.objects
+        columns = kw.pop('columns', None)
+        if objects is not None and (cls, pk) in objects:
+            #identity map中的对象可能只读取了部分列，补齐这次要读取的列
+            obj = objects[(cls, pk)]
+            if [k for k in (columns or cls.__mappings__) if not k in obj]:
+                cls.load_deferred([obj])
+            return obj
+        sql = cls.__statements__['get'] if columns is None else '%s where `%s`=?' % (_gen_select(cls.__table__, columns), cls.__primary_key__.name)
+        obj = db.select_one(sql, pk, row=cls._row, **kw)
+        if obj is not None:
+            obj = cls._remember((obj,))[0]
+        return obj
+
+    @classmethod
+    def prefetch(cls, objs, *relations):
         """
-        通过主键查询
+        为一批对象读取ForeignKey引用的对象，每个关系一条where pk in (...)查询，
+        结果作为对象的属性(如comment.user)，不存在时为None
+        关系对象不是表的字段，不会写入数据库，也不会出现在json中
         """
-        d = db.select_one('select * from %s where %s=?' % (cls.__table__, cls.__primary_key__.name), pk)
-        return cls(**d) if d else None
+        for relation in relations:
+            if not relation in cls.__relations__:
+                raise AttributeError('%s has no relation: %s' % (cls.__name__, relation))
+            key = cls.__relations__[relation]
+            model = ModelMetaclass.subclasses[cls.__mappings__[key].model]
+            keys = list(set([getattr(obj, key) for obj in objs if getattr(obj, key)]))
+            related = dict(itertools.izip(keys, model.get_many(keys)))
+            for obj in objs:
+                obj.__dict__[relation] = related.get(getattr(obj, key))
+        return objs
 
     @classmethod
-    def find_first(cls, where, *args):
+    def get_many(cls, pks, chunk_size=IN_CHUNK_SIZE, **kw):
+        """
+        按主键批量查询，每chunk_size个主键一条where pk in (...)语句
+        返回与pks顺序相同的列表，不存在的主键对应None，
+        缺少的主键可以用[pk for pk, obj in zip(pks, objs) if obj is None]得到
+        已在identity map中的对象不再查询，缺少的列一次补齐
+        """
+        pks = list(pks)
+        objects = _identity_map.objects
+        found = {}
+        if objects is not None:
+            columns = kw.get('columns') or [k for k in cls.__mappings__ if not k in cls.__deferred__]
+            for pk in pks:
+                if (cls, pk) in objects:
+                    found[pk] = objects[(cls, pk)]
+            cls.load_deferred([obj for obj in found.itervalues() if [k for k in columns if not k in obj]])
+        keys = list(set([pk for pk in pks if not pk in found]))
+        pk_name = cls.__primary_key__.name
+        select = cls._select_sql(kw)
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            sql = '%s where `%s` in (%s)' % (select, pk_name, ','.join(['?'] * len(chunk)))
+            for obj in cls._remember(db.select(sql, *chunk, row=cls._row, **kw)):
+                found[obj[pk_name]] = obj
+        objs = [found.get(pk) for pk in pks]
+        missing = len([obj for obj in objs if obj is None])
+        if missing:
+            logging.info('%s.get_many: %s of %s not found.' % (cls.__name__, missing, len(pks)))
+        return objs
+
+    @classmethod
+    def find_first(cls, where, *args, **kw):
         """
         条件查询，返回一个查询结果，如果查询到多个结果，也只返回第一个。
         如果没有查询到结果返回None
         """
-        d = db.select_one('select * from %s %s' % (cls.__table__, where), *args)
-        return cls(**d) if d else None
+        obj = db.select_one('%s %s' % (cls._select_sql(kw), where), *args, row=cls._row, **kw)
+        if obj is not None:
+            obj = cls._remember((obj,))[0]
+        return obj
 
     @classmethod
-    def find_all(cls, *args):
+    def find_all(cls, *args, **kw):
         """
         查询所有，返回一个列表
         """
-        L = db.select('select * from `%s`' % cls.__table__)
-        return [cls(**d) for d in L]
+        prefetch = kw.pop('prefetch', ())
+        return cls.prefetch(cls._remember(db.select(cls._select_sql(kw), row=cls._row, **kw)), *prefetch)
 
     @classmethod
-    def find_by(cls, where, *args):
+    def find_by(cls, where, *args, **kw):
         """
         条件查询，返回一个列表包含所有查询结果
+        prefetch: 同时批量读取的关系，如prefetch=('user',)，见`prefetch`
+        """
+        prefetch = kw.pop('prefetch', ())
+        return cls.prefetch(cls._remember(db.select('%s %s' % (cls._select_sql(kw), where), *args, row=cls._row, **kw)), *prefetch)
+
+    @classmethod
+    def find_page(cls, order_by='created_at', after=None, limit=10, desc=True, where=None, args=(), **kw):
+        """
+        按游标(keyset)分页查询，返回(对象列表, 下一页的游标)，没有下一页时游标为None
+        排序列相同的行按主键排序，从游标处用where条件定位，不使用OFFSET，翻到后面的页也不会变慢
+        after: 上一页返回的游标，None表示第一页
+        where/args: 附加的查询条件，如where='user_id=?', args=(uid,)
+        多查一行来判断是否还有下一页，不需要count
+        """
+        if not order_by in cls.__mappings__:
+            raise ValueError('Invalid order by field: %s' % order_by)
+        pk = cls.__primary_key__.name
+        conditions = [where] if where else []
+        params = list(args)
+        if after:
+            value, key = _decode_cursor(after)
+            op = '<' if desc else '>'
+            conditions.append('(`%s`%s? or (`%s`=? and `%s`%s?))' % (order_by, op, order_by, pk, op))
+            params.extend([value, value, key])
+        prefetch = kw.pop('prefetch', ())
+        if kw.get('columns') is not None:
+            #游标需要排序列的值
+            kw['columns'] = cls._columns(set(kw['columns']) | set([order_by]))
+        sql = [cls._select_sql(kw)]
+        if conditions:
+            sql.append('where %s' % ' and '.join(conditions))
+        direction = 'desc' if desc else 'asc'
+        sql.append('order by `%s` %s, `%s` %s limit ?' % (order_by, direction, pk, direction))
+        params.append(limit + 1)
+        objs = cls._remember(db.select(' '.join(sql), *params, row=cls._row, **kw))
+        if len(objs) <= limit:
+            return cls.prefetch(objs, *prefetch), None
+        objs = cls.prefetch(objs[:limit], *prefetch)
+        return objs, _encode_cursor([objs[-1][order_by], objs[-1][pk]])
+
+    # 异步查询，返回adb.Future，参数与对应的同步方法相同
+    @classmethod
+    def aget(cls, pk, **kw):
+        return adb.submit(cls.get, pk, **kw)
+
+    @classmethod
+    def afind_first(cls, where, *args, **kw):
+        return adb.submit(cls.find_first, where, *args, **kw)
+
+    @classmethod
+    def afind_by(cls, where, *args, **kw):
+        return adb.submit(cls.find_by, where, *args, **kw)
+
+    @classmethod
+    def acount_all(cls, **kw):
+        return adb.submit(cls.count_all, **kw)
+
+    @classmethod
+    def iter_by(cls, where, *args, **kw):
         """
-        L = db.select('select * from `%s` %s' % (cls.__table__, where), *args)
-        return [cls(**d) for d in L]
+        条件查询，逐个产生对象，适合遍历大表
+        batch: 每次从数据库读取的行数
+        """
+        kw['row'] = cls._row
+        return db.select_iter('%s %s' % (cls._select_sql(kw), where), *args, **kw)
 
     @classmethod
     def find_colums(cls, colums):
         """
         查询指定列
         """
-        L = db.select('select %s from `%s`' % (colums, cls.__table__))
-        return [cls(**d) for d in L]
+        return db.select('select %s from `%s`' % (colums, cls.__table__), row=cls._row)
 
     @classmethod
-    def count_all(cls):
-        return db.select_int('select count(`%s`) from `%s`' % (cls.__primary_key__.name, cls.__table__))
+    def count_all(cls, **kw):
+        return db.select_int(cls.__statements__['count_all'], **kw)
 
     @classmethod
-    def count_by(cls, where, *args):
-        return db.select_int('select count(`%s`) from `%s` `%s`' % (cls.__primary_key__.name, cls.__table__, where), *args)
+    def count_by(cls, where, *args, **kw):
+        return db.select_int('%s %s' % (cls.__statements__['count_all'], where), *args, **kw)
 
 
     # 添加实例方法
     def update(self):
+        """
+        从数据库读取的对象只更新改变了的列，没有改变时不访问数据库
+        其他对象更新所有可更新的列
+        """
         self.pre_update and self.pre_update()
         L = []
         args = []
-        for k,v in self.__mappings__.iteritems():
-            if v.updatable:
-                if hasattr(self, k):
-                    arg = getattr(self, k)
-                else:
-                    arg = v.default
-                    setattr(self, k, arg)
+        dirty = self._dirty_fields()
+        if dirty is None:
+            for k,v in self.__mappings__.iteritems():
+                if v.updatable:
+                    if hasattr(self, k):
+                        arg = getattr(self, k)
+                    else:
+                        arg = v.default
+                        setattr(self, k, arg)
+                    L.append('`%s`=?' % k)
+                    args.append(arg)
+        else:
+            for k in dirty:
                 L.append('`%s`=?' % k)
-                args.append(arg)
+                args.append(getattr(self, k))
         pk = self.__primary_key__.name
+        if not L:
+            logging.info('%s %s is not modified, skip update.' % (self.__class__.__name__, getattr(self, pk)))
+            return self
         args.append(getattr(self, pk))
-        db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        version = self.__version_field__
+        if version is None:
+            db.update('update `%s` set %s where %s=?' % (self.__table__, ','.join(L), pk), *args)
+        else:
+            #自己创建的对象可能没有版本号，按默认的版本号比较
+            current = dict.get(self, version, self.__mappings__[version].default)
+            L.append('`%s`=`%s`+1' % (version, version))
+            args.append(current)
+            if db.update('update `%s` set %s where `%s`=? and `%s`=?' % (self.__table__, ','.join(L), pk, version), *args) == 0:
+                raise StaleObjectError('%s %s has been modified since version %s.' % (self.__class__.__name__, getattr(self, pk), current))
+            self[version] = current + 1
+        self._mark_clean()
+        return self
+
+    def _reload(self):
+        """
+        从数据库重新读取所有字段，不经过identity map
+        """
+        pk = self.__primary_key__.name
+        fresh = db.select_one(self.__statements__['get'], getattr(self, pk), row=self.__class__._row)
+        if fresh is None:
+            raise StaleObjectError('%s %s has been deleted.' % (self.__class__.__name__, getattr(self, pk)))
+        dict.clear(self)
+        dict.update(self, fresh)
+        self.__dict__['_loaded'] = fresh.__dict__['_loaded']
         return self
 
+    def update_with_retry(self, fn, retries=3):
+        """
+        调用fn(self)修改对象后update()，版本冲突时重新读取对象再调用fn，最多重试retries次
+        fn会被调用多次，只能根据对象当前的值修改对象，如：
+            blog.update_with_retry(lambda b: setattr(b, 'name', name))
+        在事务中使用时，可重复读隔离级别下重新读取不到其他事务的修改，应在事务外调用
+        """
+        attempt = 0
+        while True:
+            fn(self)
+            try:
+                return self.update()
+            except StaleObjectError, e:
+                attempt = attempt + 1
+                if attempt > retries:
+                    raise
+                logging.info('%s, retry %s...' % (e, attempt))
+                self._reload()
+
     def delete(self):
         self.pre_delete and self.pre_delete()
         pk = self.__primary_key__.name
         args = (getattr(self, pk), )
-        db.update('delete from `%s` where `%s`=?' % (self.__table__, pk), *args)
+        db.update(self.__statements__['delete'], *args)
+        if _identity_map.objects is not None:
+            _identity_map.objects.pop((self.__class__, args[0]), None)
         return self
 
     def insert(self):
@@ -286,8 +790,322 @@ class Model(dict):
                     setattr(self, k, v.default)
                 params[v.name] = getattr(self, k)
         db.insert('%s' % self.__table__, **params)
+        self._mark_clean()
+        self._remember((self,))
         return self
 
+    @classmethod
+    def insert_many(cls, objs, chunk_size=db.INSERT_CHUNK_SIZE):
+        """
+        批量插入，在一个事务中用多行insert语句写入，返回objs
+        """
+        objs = list(objs)
+        rows = []
+        for obj in objs:
+            obj.pre_insert and obj.pre_insert()
+            params = {}
+            for k, v in cls.__mappings__.iteritems():
+                if v.insertable:
+                    if not hasattr(obj, k):
+                        setattr(obj, k, v.default)
+                    params[v.name] = getattr(obj, k)
+            rows.append(params)
+        db.insert_many(cls.__table__, rows, chunk_size)
+        for obj in objs:
+            obj._mark_clean()
+        return objs
+
+    @classmethod
+    def upsert(cls, obj):
+        """
+        插入obj，主键已存在时改为更新所有可更新的字段，只需一条语句，见`db.upsert`
+        有版本号的对象更新时版本号加1，之后需要重新读取才能得到新的版本号
+        """
+        obj.pre_insert and obj.pre_insert()
+        params = {}
+        for k, v in cls.__mappings__.iteritems():
+            if v.insertable:
+                if not hasattr(obj, k):
+                    setattr(obj, k, v.default)
+                params[v.name] = getattr(obj, k)
+        updates = [v.name for v in cls.__mappings__.itervalues() if v.insertable and v.updatable]
+        version = cls.__version_field__
+        db.upsert(cls.__table__, params, keys=(cls.__primary_key__.name,), updates=updates, increments=version and (version,) or ())
+        obj._mark_clean()
+        cls._remember((obj,))
+        return obj
+
+    @classmethod
+    def bulk_update(cls, objs, fields=None, chunk_size=BULK_UPDATE_CHUNK_SIZE):
+        """
+        把一批对象的fields字段写入数据库，默认是所有可更新的字段
+        每chunk_size个对象一条语句，全部在同一个事务中执行，返回objs：
+            update t set f=case pk when ? then ? ... end where pk in (...)
+        不调用pre_update，也不检查版本号，有版本号时版本号加1
+        """
+        objs = list(objs)
+        if fields is None:
+            fields = [k for k, v in cls.__mappings__.iteritems() if v.updatable]
+        for f in fields:
+            if not f in cls.__mappings__ or not cls.__mappings__[f].updatable:
+                raise ValueError('%s.%s is not an updatable field.' % (cls.__name__, f))
+        pk = cls.__primary_key__.name
+        version = cls.__version_field__
+        if not fields and not version:
+            return objs
+        #从数据库读取的对象还没有读取的字段一次读取，不在逐个访问时分别查询
+        cls.load_deferred([obj for obj in objs if '_loaded' in obj.__dict__ and [f for f in fields if not f in obj]])
+        with db.transaction():
+            for i in range(0, len(objs), chunk_size):
+                chunk = objs[i:i + chunk_size]
+                L = []
+                args = []
+                for f in fields:
+                    L.append('`%s`=case `%s` %s end' % (f, pk, ' '.join(['when ? then ?'] * len(chunk))))
+                    for obj in chunk:
+                        args.extend([getattr(obj, pk), getattr(obj, f)])
+                if version:
+                    L.append('`%s`=`%s`+1' % (version, version))
+                args.extend([getattr(obj, pk) for obj in chunk])
+                db.update('update `%s` set %s where `%s` in (%s)' % (cls.__table__, ','.join(L), pk, ','.join(['?'] * len(chunk))), *args)
+        for obj in objs:
+            if version and version in obj:
+                obj[version] = obj[version] + 1
+            obj._mark_clean()
+        return objs
+
+class _ColumnsQuery(object):
+    """
+    Model.only()/defer()的结果，查询方法与Model相同，只读取指定的列
+    """
+    def __init__(self, model, columns):
+        self.model = model
+        self.columns = columns
+
+    def _kw(self, kw):
+        kw['columns'] = self.columns
+        return kw
+
+    def get(self, pk, **kw):
+        return self.model.get(pk, **self._kw(kw))
+
+    def get_many(self, pks, **kw):
+        return self.model.get_many(pks, **self._kw(kw))
+
+    def find_first(self, where, *args, **kw):
+        return self.model.find_first(where, *args, **self._kw(kw))
+
+    def find_all(self, *args, **kw):
+        return self.model.find_all(*args, **self._kw(kw))
+
+    def find_by(self, where, *args, **kw):
+        return self.model.find_by(where, *args, **self._kw(kw))
+
+    def find_page(self, *args, **kw):
+        return self.model.find_page(*args, **self._kw(kw))
+
+    def iter_by(self, where, *args, **kw):
+        return self.model.iter_by(where, *args, **self._kw(kw))
+
+#Query.where中的条件运算符，字段名后加__op，如created_at__gt=t
+_OPERATORS = {
+    'eq': '`%s`=?',
+    'ne': '`%s`<>?',
+    'lt': '`%s`<?',
+    'le': '`%s`<=?',
+    'gt': '`%s`>?',
+    'ge': '`%s`>=?',
+    'like': '`%s` like ?',
+}
+
+#编译好的Query语句，以查询的结构(不含参数值)为键
+_compiled = {}
+
+#只有offset没有limit时使用的limit，MySQL和SQLite都不支持单独的offset
+_NO_LIMIT = 2 ** 63 - 1
+
+class Query(object):
+    """
+    链式组合的查询，每个方法返回新的Query，原来的Query不变，可以作为公共的基础查询
+        q = Comment.query().where(blog_id=blog_id)
+        q.order_by('-created_at').limit(10).prefetch('user').all()
+        q.count()
+    条件都使用参数，同样结构的查询只生成一次sql，结果保存在_compiled中
+    """
+    def __init__(self, model):
+        self._model = model
+        self._filters = ()
+        self._clauses = ()
+        self._order = ()
+        self._limit = None
+        self._offset = None
+        self._columns = None
+        self._prefetch = ()
+        self._kw = {}
+
+    def _clone(self, **attrs):
+        q = Query.__new__(Query)
+        q.__dict__.update(self.__dict__)
+        q.__dict__.update(attrs)
+        return q
+
+    def _field(self, name):
+        if not name in self._model.__mappings__:
+            raise AttributeError('%s has no field: %s' % (self._model.__name__, name))
+        return name
+
+    def where(self, *clause, **kw):
+        """
+        where(user_id=uid, created_at__gt=t)按字段比较，多个条件用and连接
+        运算符有eq、ne、lt、le、gt、ge、like和in，值为None时eq/ne生成is null/is not null
+        也可以直接写条件：where('name like ? or summary like ?', s, s)
+        """
+        filters = []
+        for key in sorted(kw.iterkeys()):
+            name, op = key.split('__', 1) if '__' in key else (key, 'eq')
+            if op != 'in' and not op in _OPERATORS:
+                raise ValueError('Invalid operator: %s' % key)
+            filters.append((self._field(name), op, kw[key]))
+        clauses = self._clauses
+        if clause:
+            clauses = clauses + ((clause[0], tuple(clause[1:])),)
+        return self._clone(_filters=self._filters + tuple(filters), _clauses=clauses)
+
+    def order_by(self, *fields):
+        """
+        '-created_at'表示降序
+        """
+        order = tuple([(self._field(f.lstrip('-')), f.startswith('-')) for f in fields])
+        return self._clone(_order=self._order + order)
+
+    def limit(self, limit):
+        return self._clone(_limit=limit)
+
+    def offset(self, offset):
+        return self._clone(_offset=offset)
+
+    def only(self, *fields):
+        return self._clone(_columns=self._model._columns(fields))
+
+    def prefetch(self, *relations):
+        return self._clone(_prefetch=self._prefetch + relations)
+
+    def cache(self, ttl):
+        """
+        结果缓存ttl秒，见`db.configure_query_cache`
+        """
+        return self._clone(_kw=dict(self._kw, cache_ttl=ttl))
+
+    def _shape(self, kind, columns):
+        filters = []
+        for name, op, value in self._filters:
+            if op == 'in':
+                filters.append((name, op, len(value)))
+            elif value is None and op in ('eq', 'ne'):
+                filters.append((name, op, None))
+            else:
+                filters.append((name, op))
+        ranged = kind in ('select', 'values')
+        return (self._model, kind, columns, tuple(filters), tuple([c[0] for c in self._clauses]),
+                ranged and self._order, ranged and (self._limit is not None or self._offset is not None), ranged and self._offset is not None)
+
+    def _compile(self, shape):
+        model, kind, columns, filters, clauses, order, limited, offset = shape
+        table = model.__table__
+        if kind == 'count':
+            sql = [model.__statements__['count_all']]
+        elif kind == 'exists':
+            sql = ['select 1 from `%s`' % table]
+        elif columns is None:
+            sql = [model.__statements__['select']]
+        else:
+            sql = [_gen_select(table, columns)]
+        conditions = []
+        for f in filters:
+            name, op = f[0], f[1]
+            if op == 'in':
+                conditions.append(f[2] and '`%s` in (%s)' % (name, ','.join(['?'] * f[2])) or '1=0')
+            elif len(f) == 3:
+                conditions.append('`%s` is %snull' % (name, op == 'ne' and 'not ' or ''))
+            else:
+                conditions.append(_OPERATORS[op] % name)
+        conditions.extend(['(%s)' % c for c in clauses])
+        if conditions:
+            sql.append('where %s' % ' and '.join(conditions))
+        if order:
+            sql.append('order by %s' % ','.join(['`%s`%s' % (name, desc and ' desc' or '') for name, desc in order]))
+        if kind == 'exists':
+            sql.append('limit 1')
+        elif limited:
+            sql.append(offset and 'limit ?,?' or 'limit ?')
+        return ' '.join(sql)
+
+    def _sql(self, kind, columns=None):
+        shape = self._shape(kind, columns)
+        sql = _compiled.get(shape)
+        if sql is None:
+            sql = self._compile(shape)
+            #缓存满后不再加入
+            if len(_compiled) < db.STATEMENT_CACHE_SIZE:
+                _compiled[shape] = sql
+        args = []
+        for name, op, value in self._filters:
+            if op == 'in':
+                args.extend(value)
+            elif not (value is None and op in ('eq', 'ne')):
+                args.append(value)
+        for clause, params in self._clauses:
+            args.extend(params)
+        if kind in ('select', 'values') and (self._limit is not None or self._offset is not None):
+            if self._offset is not None:
+                args.append(self._offset)
+            args.append(_NO_LIMIT if self._limit is None else self._limit)
+        return sql, args
+
+    def all(self):
+        sql, args = self._sql('select', self._columns)
+        objs = self._model._remember(db.select(sql, *args, row=self._model._row, **self._kw))
+        return self._model.prefetch(objs, *self._prefetch)
+
+    def first(self):
+        objs = self.limit(1).all()
+        return objs[0] if objs else None
+
+    def count(self):
+        """
+        满足条件的行数，忽略order_by和limit
+        """
+        sql, args = self._sql('count')
+        return db.select_int(sql, *args, **self._kw)
+
+    def exists(self):
+        sql, args = self._sql('exists')
+        return db.select_one(sql, *args, row='tuple', **self._kw) is not None
+
+    def values(self, *fields):
+        """
+        只读取指定的字段，返回Dict列表，不创建Model对象
+        """
+        sql, args = self._sql('values', tuple([self._field(f) for f in fields]))
+        return db.select(sql, *args, **self._kw)
+
+    def iter(self, batch=db.ITER_BATCH_SIZE):
+        """
+        流式读取，逐个产生对象，不放入identity map
+        """
+        sql, args = self._sql('select', self._columns)
+        return db.select_iter(sql, *args, batch=batch, row=self._model._row)
+
+    def __iter__(self):
+        return iter(self.all())
+
+def missing_indexes(model):
+    """
+    对比Model声明的索引和数据库中现有的索引，返回缺少的Index列表
+    """
+    live = db.table_indexes(model.__table__)
+    return [index for index in model.__indexes__ if not [i for i in live if index.covered_by(i.columns, i.unique)]]
+
 if __name__=='__main__':
     logging.basicConfig(level=logging.DEBUG)
     #db.update('drop table if exists user')
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Model的identity map、批量读取和批量更新的测试，使用SQLite内存数据库
+在www目录下运行: python -m unittest transwarp.test_orm
+"""
+
+import unittest
+
+from transwarp import db, orm, adb
+
+class OrmAuthor(orm.Model):
+    __table__ = 'authors'
+
+    id = orm.IntegerField(primary_key=True, updatable=False)
+    name = orm.StringField()
+
+class OrmPost(orm.Model):
+    __table__ = 'posts'
+
+    id = orm.IntegerField(primary_key=True, updatable=False)
+    author_id = orm.ForeignKey('OrmAuthor')
+    title = orm.StringField()
+    content = orm.TextField(deferred=True)
+    created_at = orm.FloatField()
+
+class OrmDoc(orm.Model):
+    __table__ = 'docs'
+
+    id = orm.IntegerField(primary_key=True, updatable=False)
+    title = orm.StringField()
+    version = orm.VersionField()
+
+class OrmTest(unittest.TestCase):
+    def setUp(self):
+        db.engine = None
+        db.createEngine(backend='sqlite', path=':memory:', pool_timeout=0.5)
+        db.update('create table authors (id integer primary key, name text)')
+        db.update('create table posts (id integer primary key, author_id integer, title text, content text, created_at real)')
+        db.update('create table docs (id integer primary key, title text, version integer)')
+        OrmAuthor(id=1, name='a').insert()
+        OrmPost(id=1, author_id=1, title='t1', content='c1').insert()
+
+    def tearDown(self):
+        orm.end_identity_map()
+        db.engine.close()
+        db.engine = None
+
+    def test_identity_map_completes_partial_object(self):
+        orm.begin_identity_map()
+        partial = OrmPost.only('title').find_first('where id=?', 1)
+        self.assertFalse('content' in partial)
+        post = OrmPost.get(1)
+        self.assertTrue(post is partial)
+        self.assertEqual(dict(post), dict(id=1, author_id=1, title='t1', content='c1', created_at=0.0))
+
+    def test_identity_map_merges_fuller_row(self):
+        orm.begin_identity_map()
+        partial = OrmPost.only('title').find_first('where id=?', 1)
+        partial.title = 'changed'
+        post = OrmPost.find_first('where id=?', 1)
+        self.assertTrue(post is partial)
+        self.assertEqual(dict(post), dict(id=1, author_id=1, title='changed', created_at=0.0))
+        self.assertEqual(post._dirty_fields(), ['title'])
+
+    def test_prefetch_with_empty_foreign_key(self):
+        OrmAuthor(id=2, name='b').insert()
+        # author_id使用默认的空值''
+        OrmPost(id=2, title='t2').insert()
+        OrmPost(id=3, author_id=2, title='t3').insert()
+        posts = OrmPost.find_by('order by id', prefetch=('author',))
+        self.assertEqual([p.author and p.author.name for p in posts], ['a', None, 'b'])
+
+    def test_query_offset_without_limit(self):
+        OrmPost(id=2, author_id=1, title='t2').insert()
+        OrmPost(id=3, author_id=1, title='t3').insert()
+        posts = OrmPost.query().order_by('id').offset(1).all()
+        self.assertEqual([p.id for p in posts], [2, 3])
+        self.assertEqual([p.id for p in OrmPost.query().order_by('id').offset(1).limit(1).all()], [2])
+
+    def test_versioned_update_without_version(self):
+        OrmDoc(id=1, title='d1').insert()
+        doc = OrmDoc(id=1, title='d2')
+        doc.update()
+        self.assertEqual(doc.version, 1)
+        self.assertEqual(OrmDoc.get(1).title, 'd2')
+        self.assertRaises(orm.StaleObjectError, OrmDoc(id=1, title='d3').update)
+
+    def test_bulk_update_loads_deferred_once(self):
+        OrmPost(id=2, author_id=1, title='t2', content='c2').insert()
+        posts = OrmPost.find_by('order by id')
+        for p in posts:
+            p.title = p.title.upper()
+        log = db.begin_query_log()
+        try:
+            OrmPost.bulk_update(posts)
+        finally:
+            db.end_query_log()
+        self.assertEqual(len([q for q in log.queries if q.sql.startswith('select')]), 1)
+        self.assertEqual([(p.title, p.content) for p in OrmPost.find_by('order by id')], [('T1', 'c1'), ('T2', 'c2')])
+
+    def test_bulk_update_without_fields(self):
+        posts = OrmPost.find_all()
+        log = db.begin_query_log()
+        try:
+            self.assertEqual(OrmPost.bulk_update(posts, fields=[]), posts)
+        finally:
+            db.end_query_log()
+        self.assertEqual(len(log), 0)
+
+    def test_async_uses_identity_map(self):
+        orm.begin_identity_map()
+        try:
+            post = OrmPost.get(1)
+            self.assertTrue(OrmPost.aget(1).result(5) is post)
+            self.assertEqual(OrmPost.afind_by('where id=?', 1, columns=('id', 'title')).result(5), [post])
+        finally:
+            adb.shutdown()
+
+    def pages(self, **kw):
+        ids = []
+        cursor = None
+        while True:
+            posts, cursor = OrmPost.find_page(after=cursor, limit=2, **kw)
+            ids.extend([p.id for p in posts])
+            if cursor is None:
+                return ids
+
+    def test_find_page_cursor_round_trip(self):
+        # created_at相同的行按主键排序，翻页时不重复也不遗漏
+        for i, t in [(2, 1.0), (3, 2.0), (4, 2.0), (5, 2.0), (6, 3.0), (7, 3.0)]:
+            OrmPost(id=i, author_id=1, title='t%d' % i, created_at=t).insert()
+        self.assertEqual(self.pages(), [7, 6, 5, 4, 3, 2, 1])
+        self.assertEqual(self.pages(desc=False), [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(self.pages(where='author_id=?', args=(1,)), [7, 6, 5, 4, 3, 2, 1])
+
+    def test_find_page_invalid_cursor(self):
+        # urls._get_page_by_cursor把ValueError转换为APIValueError
+        self.assertRaises(ValueError, OrmPost.find_page, after='not a cursor')
+        self.assertRaises(ValueError, OrmPost.find_page, after='e30')
+        self.assertRaises(ValueError, OrmPost.find_page, order_by='missing')
+
+    def test_query_compiled_once(self):
+        OrmPost(id=2, author_id=2, title='t2').insert()
+        orm._compiled.clear()
+        q = OrmPost.query().where(author_id=1).order_by('-id').limit(5)
+        self.assertEqual([p.id for p in q.all()], [1])
+        self.assertEqual([p.id for p in OrmPost.query().where(author_id=2).order_by('-id').limit(3).all()], [2])
+        self.assertEqual(len(orm._compiled), 1)
+        self.assertEqual(q._sql('select'), OrmPost.query().where(author_id=1).order_by('-id').limit(5)._sql('select'))
+
+    def test_query_in_and_null(self):
+        OrmPost(id=2, author_id=2, title=None).insert()
+        OrmPost(id=3, author_id=3, title='t3').insert()
+        self.assertEqual(OrmPost.query().where(id__in=[]).all(), [])
+        self.assertEqual(OrmPost.query().where(id__in=[]).count(), 0)
+        self.assertEqual(sorted([p.id for p in OrmPost.query().where(id__in=[1, 3, 9]).all()]), [1, 3])
+        self.assertEqual([p.id for p in OrmPost.query().where(title=None).all()], [2])
+        self.assertEqual([p.id for p in OrmPost.query().where(title__ne=None).order_by('id').all()], [1, 3])
+        self.assertRaises(ValueError, OrmPost.query().where, title__bad=1)
+
+    def test_upsert_insert_then_update(self):
+        OrmDoc.upsert(OrmDoc(id=1, title='d1'))
+        self.assertEqual(dict(OrmDoc.get(1)), dict(id=1, title='d1', version=0))
+        OrmDoc.upsert(OrmDoc(id=1, title='d2'))
+        OrmDoc.upsert(OrmDoc(id=1, title='d3'))
+        self.assertEqual(dict(OrmDoc.get(1)), dict(id=1, title='d3', version=2))
+        self.assertEqual(OrmDoc.count_all(), 1)
+
+    def test_upsert_counter(self):
+        db.update('create table counters (id integer primary key, hits integer, name text)')
+        for i in range(3):
+            db.upsert('counters', dict(id=1, hits=1, name='c%d' % i), updates=('name',), increments=('hits',))
+        self.assertEqual(db.select_one('select * from counters'), dict(id=1, hits=3, name='c2'))
+
+    def test_bulk_update_chunks_and_version(self):
+        for i in range(2, 6):
+            OrmDoc(id=i, title='d%d' % i).insert()
+        docs = OrmDoc.find_by('order by id')
+        for d in docs:
+            d.title = d.title.upper()
+        OrmDoc.bulk_update(docs, chunk_size=3)
+        self.assertEqual([(d.title, d.version) for d in OrmDoc.find_by('order by id')], [('D%d' % i, 1) for i in range(2, 6)])
+        self.assertEqual([d.version for d in docs], [1] * 4)
+        self.assertEqual([d._dirty_fields() for d in docs], [[]] * 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+事务上下文和连接归还的测试，使用SQLite内存数据库
+在www目录下运行: python -m unittest transwarp.test_transaction
+"""
+
+import os
+import tempfile
+import threading
+import unittest
+
+from transwarp import db, adb
+
+class TransactionTest(unittest.TestCase):
+    def setUp(self):
+        db.engine = None
+        db.createEngine(backend='sqlite', path=':memory:', pool_timeout=0.5)
+        db.update('create table t (id integer primary key, name text)')
+
+    def tearDown(self):
+        db.engine.close()
+        db.engine = None
+
+    def assertNoLeak(self):
+        # 连接池中没有被借出未还的连接，线程上也没有残留的连接上下文
+        self.assertEqual(db.pool_stats().checked_out, 0)
+        self.assertFalse(db._db_ctx.isInit())
+        self.assertEqual(db._db_ctx.transactions, 0)
+
+    def names(self):
+        return [r.name for r in db.select('select name from t order by id')]
+
+    def test_commit(self):
+        with db.transaction():
+            db.insert('t', id=1, name='a')
+            db.insert('t', id=2, name='b')
+        self.assertEqual(self.names(), ['a', 'b'])
+        self.assertNoLeak()
+
+    def test_rollback(self):
+        try:
+            with db.transaction():
+                db.insert('t', id=1, name='a')
+                raise ValueError('abort')
+        except ValueError:
+            pass
+        self.assertEqual(self.names(), [])
+        self.assertNoLeak()
+
+    def test_empty_transaction(self):
+        with db.transaction():
+            pass
+        self.assertNoLeak()
+
+    def test_nested_savepoint_rollback(self):
+        with db.transaction():
+            db.insert('t', id=1, name='a')
+            try:
+                with db.transaction():
+                    db.insert('t', id=2, name='b')
+                    raise ValueError('abort inner')
+            except ValueError:
+                pass
+            with db.transaction():
+                db.insert('t', id=3, name='c')
+        self.assertEqual(self.names(), ['a', 'c'])
+        self.assertNoLeak()
+
+    def test_nested_error_rolls_back_outer(self):
+        try:
+            with db.transaction():
+                db.insert('t', id=1, name='a')
+                with db.transaction():
+                    db.insert('t', id=2, name='b')
+                    raise ValueError('abort all')
+        except ValueError:
+            pass
+        self.assertEqual(self.names(), [])
+        self.assertNoLeak()
+
+    def test_failed_statement_returns_connection(self):
+        self.assertRaises(Exception, db.select, 'select * from missing')
+        self.assertRaises(Exception, db.update, 'update missing set x=1')
+        try:
+            with db.transaction():
+                db.update('update missing set x=1')
+        except Exception:
+            pass
+        self.assertNoLeak()
+
+    def test_connection_ctx(self):
+        with db.connection():
+            db.select('select 1')
+            with db.transaction():
+                db.insert('t', id=1, name='a')
+            self.assertTrue(db._db_ctx.isInit())
+        self.assertEqual(self.names(), ['a'])
+        self.assertNoLeak()
+
+    def test_abandoned_iterator(self):
+        db.insert_many('t', [dict(id=i, name='n%d' % i) for i in range(10)])
+        it = db.select_iter('select * from t', batch=2)
+        it.next()
+        del it
+        self.assertNoLeak()
+
+    def test_no_leak_under_repeated_use(self):
+        # 内存数据库只有一个连接，泄漏一次后面的操作就会超时
+        for i in range(50):
+            with db.transaction():
+                db.insert('t', id=i, name='x')
+            db.select_one('select * from t where id=?', i)
+        self.assertEqual(db.select_int('select count(*) from t'), 50)
+        self.assertNoLeak()
+
+class DisconnectTest(unittest.TestCase):
+    """
+    事务中连接断开，使用文件数据库，丢弃连接不会丢失数据
+    """
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        db.engine = None
+        db.createEngine(backend='sqlite', path=self.path, pool_timeout=0.5)
+        db.update('create table t (id integer primary key, name text)')
+        # 把访问不存在的表boom当作连接断开
+        db.engine.dialect.is_disconnect = lambda e: 'boom' in str(e)
+
+    def tearDown(self):
+        db.engine.close()
+        db.engine = None
+        os.remove(self.path)
+
+    def test_disconnect_fails_transaction(self):
+        def work():
+            with db.transaction():
+                db.insert('t', id=1, name='before')
+                try:
+                    with db.transaction():
+                        db.insert('t', id=2, name='inner')
+                        db.update('update boom set x=1')
+                except Exception, e:
+                    self.assertTrue('boom' in str(e))
+                db.insert('t', id=3, name='after-inner')
+        self.assertRaises(db.DBError, work)
+        self.assertEqual(db.select('select * from t'), [])
+        self.assertEqual(db.pool_stats().checked_out, 0)
+        # 事务结束后可以正常使用新的连接
+        with db.transaction():
+            db.insert('t', id=4, name='next')
+        self.assertEqual(db.select_int('select count(*) from t'), 1)
+
+class DeadlineTest(unittest.TestCase):
+    """
+    语句时限由一个后台线程统一处理
+    """
+    def setUp(self):
+        db.engine = None
+        db.createEngine(backend='sqlite', path=':memory:', pool_timeout=0.5)
+        db.update('create table t (id integer primary key, name text)')
+
+    def tearDown(self):
+        db.end_request()
+        db.engine.close()
+        db.engine = None
+
+    def test_no_thread_per_statement(self):
+        db.set_deadline(10)
+        db.select_int('select count(*) from t')
+        threads = threading.active_count()
+        for i in range(50):
+            db.insert('t', id=i, name='x')
+            db.select_one('select * from t where id=?', i)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(db.select_int('select count(*) from t'), 50)
+
+    def test_timeout_cancels_statement(self):
+        db.set_deadline(0.2)
+        slow = 'with recursive c(x) as (select 1 union all select x+1 from c) select count(*) from c'
+        self.assertRaises(db.QueryTimeoutError, db.select_int, slow)
+        db.end_request()
+        self.assertEqual(db.select_int('select count(*) from t'), 0)
+        self.assertEqual(db.pool_stats().checked_out, 0)
+
+    def test_select_iter_after_deadline(self):
+        db.set_deadline(-1)
+        self.assertRaises(db.QueryTimeoutError, lambda: list(db.select_iter('select 1 as x')))
+        db.end_request()
+        self.assertEqual(db.pool_stats().checked_out, 0)
+
+    def test_select_iter_timeout_cancels_statement(self):
+        slow = 'with recursive c(x) as (select 1 union all select x+1 from c) select count(*) as n from c'
+        self.assertRaises(db.QueryTimeoutError, lambda: list(db.select_iter(slow, timeout=0.2)))
+        self.assertEqual(db.pool_stats().checked_out, 0)
+        self.assertEqual([r.x for r in db.select_iter('select 1 as x', timeout=10)], [1])
+
+class QueryCacheTest(unittest.TestCase):
+    def setUp(self):
+        db.engine = None
+        db.createEngine(backend='sqlite', path=':memory:', pool_timeout=0.5)
+        db.configure_query_cache()
+        db.update('create table t (id integer primary key, name text)')
+        db.insert_many('t', [dict(id=1, name='a'), dict(id=2, name='b')])
+
+    def tearDown(self):
+        db._query_cache = None
+        db.engine.close()
+        db.engine = None
+
+    def test_select_one_and_select_share_sql(self):
+        sql = 'select * from t order by id'
+        self.assertEqual(db.select_one(sql, cache_ttl=60).name, 'a')
+        self.assertEqual([r.name for r in db.select(sql, cache_ttl=60)], ['a', 'b'])
+        self.assertEqual(db.select_one(sql, cache_ttl=60), dict(id=1, name='a'))
+        self.assertEqual(db.query_cache_stats().hits, 1)
+
+    def test_write_invalidates(self):
+        sql = 'select name from t where id=?'
+        self.assertEqual(db.select_one(sql, 1, cache_ttl=60).name, 'a')
+        db.update('update t set name=? where id=?', 'x', 1)
+        self.assertEqual(db.select_one(sql, 1, cache_ttl=60).name, 'x')
+
+    def test_comma_join_invalidates(self):
+        db.update('create table u (id integer primary key, name text)')
+        db.insert('u', id=1, name='x')
+        sql = 'select t.name, u.name as other from t, u where t.id=u.id'
+        self.assertEqual(db.select_one(sql, cache_ttl=60).other, 'x')
+        db.update('update u set name=? where id=?', 'y', 1)
+        self.assertEqual(db.select_one(sql, cache_ttl=60).other, 'y')
+
+    def test_derived_table_not_cached(self):
+        sql = 'select count(*) as c from (select * from t) d'
+        self.assertEqual(db.select_one(sql, cache_ttl=60).c, 2)
+        db.insert('t', id=3, name='c')
+        self.assertEqual(db.select_one(sql, cache_ttl=60).c, 3)
+        self.assertEqual(db.select_one(sql, cache_ttl=60, cache_tables=('t',)).c, 3)
+
+class AsyncContextTest(unittest.TestCase):
+    """
+    adb的工作线程使用调用者的请求上下文
+    """
+    def setUp(self):
+        db.engine = None
+        db.createEngine(backend='sqlite', path=':memory:', pool_timeout=0.5)
+        db.update('create table t (id integer primary key, name text)')
+        db.insert('t', id=1, name='a')
+
+    def tearDown(self):
+        adb.shutdown()
+        db.end_request()
+        db.engine.close()
+        db.engine = None
+
+    def test_reject_in_transaction(self):
+        with db.transaction():
+            self.assertRaises(db.DBError, adb.select_int, 'select count(*) from t')
+
+    def test_deadline(self):
+        db.set_deadline(-1)
+        self.assertRaises(db.QueryTimeoutError, adb.select_int('select count(*) from t').result, 5)
+
+    def test_query_log(self):
+        log = db.begin_query_log()
+        try:
+            self.assertEqual(adb.select_int('select count(*) from t').result(5), 1)
+        finally:
+            db.end_query_log()
+        self.assertEqual([q.sql for q in log.queries], ['select count(*) from t'])
+
+    def test_sticky_window(self):
+        db.engine.sticky = 10
+        db.update('update t set name=? where id=?', 'b', 1)
+        sticky = db._db_ctx.sticky_until
+        self.assertEqual(adb.submit(lambda: db._db_ctx.sticky_until).result(5), sticky)
+        db.end_request()
+        adb.update('update t set name=? where id=?', 'c', 1).result(5)
+        self.assertTrue(db._db_ctx.sticky_until > 0)
+
+class FakeCursor(object):
+    def __init__(self, connection, prepared=False):
+        self.connection = connection
+        self.prepared = prepared
+        self.closed = False
+        self.description = None
+        self.rowcount = 0
+
+    def execute(self, sql, args=()):
+        self.connection.log.append(sql)
+        if sql.startswith('start transaction'):
+            self.connection.in_transaction = True
+        elif sql.startswith('select'):
+            self.description = [('x',)]
+        else:
+            self.rowcount = 1
+
+    def fetchone(self):
+        return (1,)
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        self.closed = True
+
+class FakeConnection(object):
+    """
+    记录执行的语句，和autocommit=True的mysql.connector一样只在显式开始的事务中in_transaction为True
+    """
+    def __init__(self):
+        self.log = []
+        self.in_transaction = False
+        self.cursors = []
+
+    def cursor(self, prepared=False, **kw):
+        self.cursors.append(FakeCursor(self, prepared))
+        return self.cursors[-1]
+
+    def commit(self):
+        self.log.append('COMMIT')
+        self.in_transaction = False
+
+    def rollback(self):
+        self.log.append('ROLLBACK')
+        self.in_transaction = False
+
+    def ping(self, reconnect=False):
+        pass
+
+    def close(self):
+        pass
+
+class RoundTripTest(unittest.TestCase):
+    """
+    事务外的读写不多出COMMIT/ROLLBACK往返
+    """
+    def setUp(self):
+        self.connection = FakeConnection()
+        db.engine = db._Engine(lambda: self.connection, db._MySQLDialect(), min_size=0, max_size=1)
+
+    def tearDown(self):
+        db.engine.close()
+        db.engine = None
+
+    def test_select_and_update_outside_transaction(self):
+        db.select_one('select x from t where id=?', 1)
+        db.update('update t set x=? where id=?', 2, 1)
+        self.assertEqual(self.connection.log, ['select x from t where id=%s', 'update t set x=%s where id=%s'])
+
+    def test_transaction_is_committed(self):
+        with db.transaction():
+            db.update('update t set x=? where id=?', 2, 1)
+        self.assertEqual(self.connection.log, ['start transaction', 'update t set x=%s where id=%s', 'COMMIT'])
+
+    def test_open_transaction_is_rolled_back_on_release(self):
+        connection = db.engine.connect()
+        connection.connection.in_transaction = True
+        db.engine.release(connection)
+        self.assertEqual(self.connection.log, ['ROLLBACK'])
+
+class PreparedCursorTest(unittest.TestCase):
+    def setUp(self):
+        self.connection = FakeConnection()
+        db.engine = db._Engine(lambda: self.connection, db._MySQLDialect(), dict(prepared=True), min_size=0, max_size=1)
+
+    def tearDown(self):
+        db.engine.close()
+        db.engine = None
+
+    def test_variable_arity_not_prepared(self):
+        for n in (1, 2, 3):
+            db.select('select x from t where id in (%s)' % ','.join(['?'] * n), *range(n))
+        self.assertEqual([c.prepared for c in self.connection.cursors], [False] * 3)
+        self.assertTrue(all([c.closed for c in self.connection.cursors]))
+
+    def test_prepared_cursors_are_evicted(self):
+        size = db.PREPARED_CACHE_SIZE
+        for i in range(size + 1):
+            db.select('select x from t where id=? and %s=%s' % (i, i), 1)
+        db.select('select x from t where id=? and %s=%s' % (size, size), 1)
+        cursors = self.connection.cursors
+        self.assertEqual(len(cursors), size + 1)
+        self.assertTrue(all([c.prepared for c in cursors]))
+        self.assertEqual([c.closed for c in cursors], [True] + [False] * size)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1251,6 +1251,68 @@ def interceptor(pattern='/'):
 
     return _decorator
 
+def db_request_interceptor(timeout=None, pattern='/'):
+    """
+    timeout不为None时，请求中的所有数据库语句必须在请求开始后timeout秒内完成，
+    否则在服务器端取消并抛出db.QueryTimeoutError
+    请求结束时清除数据库层与请求相关的状态，如写后读主库的时间窗口
+    """
+    import db
+
+    @interceptor(pattern)
+    def _db_request_interceptor(next):
+        if timeout is not None:
+            db.set_deadline(timeout)
+        try:
+            return next()
+        finally:
+            db.end_request()
+
+    return _db_request_interceptor
+
+def identity_map_interceptor(pattern='/'):
+    """
+    请求期间开启ORM的identity map，同一请求中按主键重复读取的对象不再查询数据库
+    """
+    import orm
+
+    @interceptor(pattern)
+    def _identity_map_interceptor(next):
+        orm.begin_identity_map()
+        try:
+            return next()
+        finally:
+            orm.end_identity_map()
+
+    return _identity_map_interceptor
+
+def query_log_interceptor(max_queries=30, max_db_time=0.5, max_repeats=5, pattern='/'):
+    """
+    记录每个请求执行的sql语句，请求期间可以通过ctx.query_log访问
+    查询次数超过max_queries、数据库耗时超过max_db_time秒，或同一语句执行
+    超过max_repeats次(可能是N+1查询)时输出警告日志
+    """
+    import db
+
+    @interceptor(pattern)
+    def _query_log_interceptor(next):
+        log = ctx.query_log = db.begin_query_log()
+        try:
+            return next()
+        finally:
+            db.end_query_log()
+            del ctx.query_log
+            path = ctx.request.path_info
+            if len(log) > max_queries or log.db_time > max_db_time:
+                logging.warning('[QUERIES] %s: %s' % (path, log))
+                for q in log.queries:
+                    logging.warning('[QUERIES]   %.3fs %s rows %s (%s)' % (q.time, q.rows, q.sql, q.caller))
+            for sql, count in log.repeated(max_repeats):
+                callers = set([q.caller for q in log.queries if q.sql == sql])
+                logging.warning('[N+1] %s: %s times %s from %s' % (path, count, sql, ', '.join(callers)))
+
+    return _query_log_interceptor
+
 def _build_interceptor_fn(func, next):
     def _wrapper():
         if func.__interceptor__(ctx.request.path_info):
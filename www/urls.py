@@ -6,6 +6,7 @@ import markdown2
 from transwarp.web import get, post, ctx, view, interceptor, seeother, notfound
 from apis import api, Page, APIError, APIValueError, APIPermissionError, APIResourceNotFoundError
 from models import User, Blog, Comment
+from transwarp import db
 from config import configs
 
 _COOKIE_NAME = 'awesession'
@@ -48,14 +49,37 @@ def _get_page_index():
         pass
     return page_index
 
+#首页和管理页的日志列表缓存秒数，日志修改时缓存失效
+_BLOG_CACHE_TTL = 60
+
 def _get_blogs_by_page():
-    total = Blog.count_all()
+    total = Blog.count_all(cache_ttl=_BLOG_CACHE_TTL)
     page = Page(total, _get_page_index())
     print page
-    blogs = Blog.find_by('ORDER BY created_at DESC limit ?,?', 
-        page.offset, page.limit)
+    blogs = Blog.query().order_by('-created_at').limit(page.limit).offset(page.offset).cache(_BLOG_CACHE_TTL).all()
     return blogs, page
 
+def _get_page_by_cursor(model, **kw):
+    '''
+    按请求中的?cursor=游标分页，cursor为空表示第一页
+    '''
+    cursor = ctx.request.get('cursor')
+    try:
+        items, next_cursor = model.find_page(after=cursor or None, **kw)
+    except ValueError:
+        raise APIValueError('cursor', 'invalid cursor.')
+    return items, Page.from_cursor(cursor, next_cursor)
+
+def _fill_authors(items):
+    '''
+    用prefetch的作者刷新冗余的user_name/user_image，作者不存在(如匿名评论)时保留原值
+    '''
+    for item in items:
+        if item.user:
+            item.user_name = item.user.name
+            item.user_image = item.user.image
+    return items
+
 @interceptor('/')
 def user_interceptor(next):
     logging.info('try to bind user from session cookie...')
@@ -95,8 +119,8 @@ def blog(blog_id):
     if blog is None:
         raise notfound()
     blog.html_content = markdown2.markdown(blog.content)
-    comments = Comment.find_by('where blog_id=? order by created_at desc limit 1000', blog_id)
-    return dict(blog=blog, comments=comments, user=ctx.request.user)
+    comments = Comment.query().where(blog_id=blog_id).order_by('-created_at').limit(1000).prefetch('user').all()
+    return dict(blog=blog, comments=_fill_authors(comments), user=ctx.request.user)
 
 @view('signin.html')
 @get('/signin')
@@ -135,8 +159,9 @@ def about():
 def archive():
     '''
     文章列表页面
+    模板渲染时逐行读取，不把整张表读进内存
     '''
-    blogs = Blog.find_colums('id,name,created_at')
+    blogs = Blog.query().only('name', 'created_at').order_by('-created_at').iter()
     return dict(blogs=blogs, user=ctx.request.user)
 
 ###################### 管理页面 #########################################
@@ -188,8 +213,12 @@ def api_get_blogs():
     获取日志API
     '''
     format = ctx.request.get('format', '')
-    blogs, page = _get_blogs_by_page()
+    if ctx.request.get('cursor') is not None:
+        blogs, page = _get_page_by_cursor(Blog, cache_ttl=_BLOG_CACHE_TTL)
+    else:
+        blogs, page = _get_blogs_by_page()
     if format=='html':
+        Blog.load_deferred(blogs)
         for blog in blogs:
             blog.content = markdown2.markdown(blog.content)
 
@@ -296,11 +325,14 @@ def api_delete_comment(comment_id):
 @api
 @get('/api/comments')
 def api_get_comments():
+    if ctx.request.get('cursor') is not None:
+        comments, page = _get_page_by_cursor(Comment, prefetch=('user',))
+        return dict(comments=_fill_authors(comments), page=page)
     total = Comment.count_all()
     page = Page(total, _get_page_index())
     #comments = Comment.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
-    comments = Comment.find_by('order by created_at desc')
-    return dict(comments = comments, page=page)
+    comments = Comment.find_by('order by created_at desc', prefetch=('user',))
+    return dict(comments = _fill_authors(comments), page=page)
 
 @api
 @post('/api/authenticate')
@@ -359,9 +391,30 @@ def api_get_users():
     '''
     获取用户API
     '''
-    total = User.count_all()
-    page = Page(total, _get_page_index())
-    users = User.find_by('order by created_at desc limit ?,?', page.offset, page.limit)
+    if ctx.request.get('cursor') is not None:
+        users, page = _get_page_by_cursor(User)
+    else:
+        total = User.count_all()
+        page = Page(total, _get_page_index())
+        users = User.query().order_by('-created_at').limit(page.limit).offset(page.offset).all()
     for u in users:
         u.password = '******'
     return dict(users=users, page=page)
+
+@api
+@get('/api/db/stats')
+def api_get_db_stats():
+    '''
+    数据库连接池统计API
+    '''
+    check_admin()
+    return db.pool_stats()
+
+@api
+@get('/api/db/queries')
+def api_get_db_queries():
+    '''
+    慢查询、按语句指纹汇总的查询统计及查询缓存命中情况API
+    '''
+    check_admin()
+    return dict(slow=db.slow_queries(), stats=db.query_stats(), cache=db.query_cache_stats())
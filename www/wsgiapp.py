@@ -10,7 +10,7 @@ import os,time
 from datetime import datetime
 
 from transwarp import db
-from transwarp.web import WSGIApplication, Jinja2TemplateEngine
+from transwarp.web import WSGIApplication, Jinja2TemplateEngine, query_log_interceptor, db_request_interceptor, identity_map_interceptor
 from config import configs
 
 def datetime_filter(t):
@@ -28,6 +28,8 @@ def datetime_filter(t):
 
 # 初始化数据库:
 db.createEngine(**configs.db)
+db.configure_slow_log()
+db.configure_query_cache()
 
 # 初始化WEB框架:
 wsgi = WSGIApplication(os.path.dirname(os.path.abspath(__file__)))
@@ -39,6 +41,9 @@ wsgi.template_engine = template_engine
 # 加载urls
 import urls
 
+wsgi.add_interceptor(query_log_interceptor())
+wsgi.add_interceptor(db_request_interceptor(timeout=10))
+wsgi.add_interceptor(identity_map_interceptor())
 wsgi.add_interceptor(urls.user_interceptor)
 wsgi.add_interceptor(urls.manage_interceptor)
 wsgi.add_module(urls)